@@ -0,0 +1,155 @@
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import date
+from functools import lru_cache
+from pathlib import Path
+from config import ANALYTICS_DB_FILE
+from call_dates import parse_call_date
+from loguru import logger
+
+# Бинарные поля отчёта: в дневных агрегатах храним их суммы, доля = сумма / calls
+FLAG_FIELDS = [
+    "intro",
+    "car_body_known",
+    "car_year_known",
+    "mileage_known",
+    "complex_diagnosis_offer",
+    "previous_works_known",
+    "farewell",
+    "followed_all_instructions",
+]
+
+# Категориальные поля: в агрегатах храним количество звонков по каждому значению
+COUNT_FIELDS = ["request_type", "result", "top100_work", "spare_parts", "branch"]
+
+TEXT_FIELDS = ["manager", "service_date", "which_recommendations_not_followed", "comment"]
+
+
+def as_flag(value) -> int:
+    try:
+        return 1 if int(value) else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+class AnalyticsStore:
+    """
+    SQLite store of analysed calls keyed by (date, phone, source).
+    Daily sums and per-field value counts are updated in the same transaction as the insert,
+    so reports read only the aggregate tables regardless of history size.
+    """
+
+    def __init__(self, path: Path = Path(ANALYTICS_DB_FILE)):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(
+                [f"{f} INTEGER" for f in FLAG_FIELDS] + [f"{f} TEXT" for f in COUNT_FIELDS + TEXT_FIELDS]
+            )
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS calls (
+                    date TEXT NOT NULL, phone TEXT NOT NULL, source TEXT NOT NULL, {columns},
+                    PRIMARY KEY (date, phone, source)
+                )""")
+            flag_sums = ", ".join(f"{f} INTEGER NOT NULL DEFAULT 0" for f in FLAG_FIELDS)
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS daily_stats (
+                    date TEXT PRIMARY KEY, calls INTEGER NOT NULL DEFAULT 0, {flag_sums}
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS daily_field_counts (
+                    date TEXT NOT NULL, field TEXT NOT NULL, value TEXT NOT NULL, count INTEGER NOT NULL,
+                    PRIMARY KEY (date, field, value)
+                )""")
+
+    def _connect(self) -> sqlite3.Connection:
+        # with conn: только фиксирует транзакцию, соединение закрываем через contextlib.closing
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _apply(conn, row: dict, sign: int):
+        flag_columns = ", ".join(["calls"] + FLAG_FIELDS)
+        placeholders = ", ".join("?" * (len(FLAG_FIELDS) + 2))
+        updates = ", ".join(f"{f} = {f} + excluded.{f}" for f in ["calls"] + FLAG_FIELDS)
+        conn.execute(
+            f"INSERT INTO daily_stats (date, {flag_columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT(date) DO UPDATE SET {updates}",
+            [row["date"], sign] + [sign * row[f] for f in FLAG_FIELDS],
+        )
+        for field in COUNT_FIELDS:
+            conn.execute(
+                "INSERT INTO daily_field_counts (date, field, value, count) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(date, field, value) DO UPDATE SET count = count + excluded.count",
+                (row["date"], field, row[field] or "", sign),
+            )
+
+    def add(self, report: dict, source: str):
+        """Inserts a call (fields as in build_daily_report); re-inserting the same key replaces it."""
+        try:
+            # Даты храним в ISO: фильтры по диапазону и сортировка идут строковым сравнением
+            call_date = parse_call_date(str(report["date"]))
+            if call_date is None:
+                raise ValueError(f"Unrecognised call date {report['date']!r}")
+            row = {"date": call_date.isoformat(), "phone": str(report["phone"]), "source": source}
+            row.update({f: as_flag(report.get(f)) for f in FLAG_FIELDS})
+            row.update({f: str(report.get(f) or "") for f in COUNT_FIELDS + TEXT_FIELDS})
+
+            with self._lock, closing(self._connect()) as conn, conn:
+                conn.row_factory = sqlite3.Row
+                previous = conn.execute(
+                    "SELECT * FROM calls WHERE date = ? AND phone = ? AND source = ?",
+                    (row["date"], row["phone"], source),
+                ).fetchone()
+                if previous is not None:
+                    self._apply(conn, dict(previous), -1)
+
+                columns = ", ".join(row)
+                conn.execute(
+                    f"INSERT OR REPLACE INTO calls ({columns}) VALUES ({', '.join('?' * len(row))})",
+                    list(row.values()),
+                )
+                self._apply(conn, row, 1)
+                conn.execute("DELETE FROM daily_field_counts WHERE count <= 0")
+        except Exception as e:
+            logger.error(f"[ERROR] Failed to store analytics for {source}: {e}")
+            raise e
+
+    def daily_report(self, date_from: str | None = None, date_to: str | None = None, top: int = 10) -> list[dict]:
+        """date_from and date_to are inclusive ISO dates (YYYY-MM-DD); anything else raises ValueError."""
+        where, params = [], []
+        if date_from:
+            where.append("date >= ?")
+            params.append(date.fromisoformat(date_from).isoformat())
+        if date_to:
+            where.append("date <= ?")
+            params.append(date.fromisoformat(date_to).isoformat())
+        condition = f"WHERE {' AND '.join(where)}" if where else ""
+
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            days = {
+                r["date"]: {
+                    "date": r["date"],
+                    "calls": r["calls"],
+                    "compliance": {f: round(r[f] / r["calls"], 4) if r["calls"] else 0.0 for f in FLAG_FIELDS},
+                    **{field: {} for field in COUNT_FIELDS},
+                }
+                for r in conn.execute(f"SELECT * FROM daily_stats {condition} ORDER BY date", params)
+            }
+            for r in conn.execute(
+                f"SELECT date, field, value, count FROM daily_field_counts {condition} ORDER BY count DESC", params
+            ):
+                if r["date"] in days:
+                    days[r["date"]][r["field"]][r["value"]] = r["count"]
+
+        for day in days.values():
+            day["top100_work"] = dict(list(day["top100_work"].items())[:top])
+        return list(days.values())
+
+
+@lru_cache(maxsize=1)
+def get_analytics_store() -> AnalyticsStore:
+    """Opens (and creates) ANALYTICS_DB_FILE on first use rather than on import."""
+    return AnalyticsStore()
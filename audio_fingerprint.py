@@ -0,0 +1,227 @@
+import json
+import math
+import hashlib
+import threading
+from collections import defaultdict
+import numpy as np
+from pathlib import Path
+from config import FINGERPRINT_INDEX_FILE, FINGERPRINT_MAX_DISTANCE, SILENCE_THRESHOLD_DBFS
+from transcribe_audio import SAMPLE_RATE, stream_pcm_chunks
+from loguru import logger
+
+FRAME_SECONDS = 0.1
+# Полосы в телефонном диапазоне, биты — знак разности энергий соседних полос во времени
+BAND_EDGES_HZ = [300, 500, 800, 1200, 1800, 2700, 3400]
+BITS_PER_FRAME = len(BAND_EDGES_HZ) - 2
+# Сравнение идёт по блокам: у дубликата совпадает каждый блок, а не только общая музыка ожидания
+BLOCK_SECONDS = 10.0
+MIN_BLOCK_VOICED_SECONDS = 2.0
+# Перекодирование меняет длительность на доли секунды, разные звонки почти всегда отличаются сильнее
+DURATION_TOLERANCE_SECONDS = 1.0
+# Кратно FRAME_SECONDS, чтобы кадры не резались на границе блоков
+DECODE_BLOCK_SECONDS = 60.0
+
+
+def file_md5(file_path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def frame_features(frames: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Log band energies and loudness (dBFS) of each frame."""
+    spectrum = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(frames.shape[1], 1 / SAMPLE_RATE)
+    bands = np.stack([
+        spectrum[:, (freqs >= low) & (freqs < high)].sum(axis=1)
+        for low, high in zip(BAND_EDGES_HZ, BAND_EDGES_HZ[1:])
+    ], axis=1)
+    dbfs = 20 * np.log10(np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1)) + 1e-10)
+    return np.log(bands + 1e-10), dbfs
+
+
+def compute_fingerprint(audio_path: Path, silence_dbfs: float = SILENCE_THRESHOLD_DBFS) -> dict | None:
+    """
+    Acoustic fingerprint of the whole call that survives re-encoding: one bit per band pair and frame,
+    set when the band energy difference grows over time, plus a mask of voiced frames and the duration.
+    Audio is decoded in DECODE_BLOCK_SECONDS blocks, so memory does not grow with the call length.
+    """
+    frame = int(FRAME_SECONDS * SAMPLE_RATE)
+    bits, voiced = [], []
+    # Последний кадр блока нужен для битов первого кадра следующего блока
+    prev_diff, prev_voiced = None, None
+    n_samples = 0
+
+    for _, chunk, _ in stream_pcm_chunks(audio_path, DECODE_BLOCK_SECONDS, 0.0):
+        n_samples += len(chunk)
+        n_frames = len(chunk) // frame
+        if not n_frames:
+            continue
+        energy, dbfs = frame_features(chunk[:n_frames * frame].reshape(n_frames, frame))
+        band_diff = energy[:, :-1] - energy[:, 1:]
+        is_voiced = dbfs > silence_dbfs
+        if prev_diff is not None:
+            band_diff = np.concatenate([prev_diff, band_diff])
+            is_voiced = np.concatenate([prev_voiced, is_voiced])
+
+        bits.append((band_diff[1:] - band_diff[:-1]) > 0)
+        voiced.append(is_voiced[1:] & is_voiced[:-1])
+        prev_diff, prev_voiced = band_diff[-1:], is_voiced[-1:]
+
+    bits = np.concatenate(bits) if bits else np.zeros((0, BITS_PER_FRAME), dtype=bool)
+    if not len(bits):
+        return None
+    return {
+        "duration": round(n_samples / SAMPLE_RATE, 2),
+        "frames": len(bits),
+        "bits": np.packbits(bits.flatten()).tobytes().hex(),
+        "voiced": np.packbits(np.concatenate(voiced)).tobytes().hex(),
+    }
+
+
+def unpack_fingerprint(fingerprint: dict) -> tuple[np.ndarray, np.ndarray]:
+    n = fingerprint["frames"]
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex(fingerprint["bits"]), dtype=np.uint8))
+    voiced = np.unpackbits(np.frombuffer(bytes.fromhex(fingerprint["voiced"]), dtype=np.uint8))
+    return bits[:n * BITS_PER_FRAME].reshape(n, BITS_PER_FRAME).astype(bool), voiced[:n].astype(bool)
+
+
+def fingerprint_distance(a: dict, b: dict) -> float:
+    """
+    Worst share of differing bits over 10 s blocks. Frames silent in both recordings are ignored,
+    frames voiced in only one of them count as fully different. 1.0 when durations do not match.
+    """
+    if abs(a["duration"] - b["duration"]) > DURATION_TOLERANCE_SECONDS:
+        return 1.0
+    bits_a, voiced_a = unpack_fingerprint(a)
+    bits_b, voiced_b = unpack_fingerprint(b)
+    n = min(len(bits_a), len(bits_b))
+
+    compared = voiced_a[:n] | voiced_b[:n]
+    differs = (bits_a[:n] != bits_b[:n]).mean(axis=1)
+    differs[voiced_a[:n] != voiced_b[:n]] = 1.0
+
+    block = int(BLOCK_SECONDS / FRAME_SECONDS)
+    min_voiced = int(MIN_BLOCK_VOICED_SECONDS / FRAME_SECONDS)
+    worst = None
+    for start in range(0, n, block):
+        mask = compared[start:start + block]
+        if mask.sum() < min_voiced:
+            continue
+        distance = float(differs[start:start + block][mask].mean())
+        worst = distance if worst is None else max(worst, distance)
+    # Сравнивать нечего (обе записи почти целиком тишина) — дубликатом не считаем
+    return 1.0 if worst is None else worst
+
+
+class FingerprintIndex:
+    """
+    Local index of processed recordings (Drive md5 + acoustic fingerprint) with dedup counters.
+    Every decision is appended to the file as one JSON line; lookups and counters are rebuilt from it on load.
+    Methods are safe to call from worker threads.
+    """
+
+    def __init__(self, path: Path = Path(FINGERPRINT_INDEX_FILE)):
+        self.path = path
+        self.stats = {"unique": 0, "md5_duplicates": 0, "acoustic_duplicates": 0, "already_processed_duplicates": 0,
+                      "skipped": 0}
+        self._md5: dict[str, str] = {}
+        # Имена всех файлов, по которым уже принято решение: обработан, дубликат или пропущен
+        self._handled: set[str] = set()
+        # Отпечатки сгруппированы по целым секундам длительности: сравниваем только записи близкой длины
+        self._by_duration: defaultdict[int, list[tuple[str, dict]]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+        if path.exists():
+            self._load()
+
+    def _load(self):
+        with self.path.open("r", encoding="utf-8") as f:
+            for n, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка после падения
+                    continue
+                if n == 0 and "entries" in record:
+                    self._migrate(record)
+                    return
+                self._apply(record)
+
+    def _migrate(self, legacy: dict):
+        # Прежний формат — один JSON со всеми записями и счётчиками; переписываем построчно один раз
+        entries = legacy.get("entries", [])
+        stats = dict(legacy.get("stats", {}))
+        stats["unique"] = max(stats.get("unique", 0) - len(entries), 0)
+        records = [{"legacy_stats": stats}, *entries]
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        tmp_path.replace(self.path)
+        for record in records:
+            self._apply(record)
+
+    def _apply(self, record: dict):
+        if "legacy_stats" in record:
+            for key, value in record["legacy_stats"].items():
+                self.stats[key] = self.stats.get(key, 0) + value
+            return
+
+        self._handled.add(record["name"])
+        if "skipped" in record:
+            self.stats["skipped"] += 1
+            return
+
+        if "duplicate_of" in record:
+            key = f"{record['kind']}_duplicates"
+            self.stats[key] = self.stats.get(key, 0) + 1
+            return
+
+        self.stats["unique"] += 1
+        if record.get("md5"):
+            self._md5[record["md5"]] = record["name"]
+        # Отпечатки старого формата (строка по первым секундам) не сравниваем, md5 по ним работает
+        fingerprint = record.get("fingerprint")
+        if isinstance(fingerprint, dict):
+            self._by_duration[math.floor(fingerprint["duration"])].append((record["name"], fingerprint))
+
+    def _append(self, record: dict):
+        with self._lock:
+            self._apply(record)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def is_handled(self, name: str) -> bool:
+        with self._lock:
+            return name in self._handled
+
+    def find_by_md5(self, md5: str | None) -> str | None:
+        with self._lock:
+            return self._md5.get(md5) if md5 else None
+
+    def find_acoustic(self, fingerprint: dict | None, max_distance: float = FINGERPRINT_MAX_DISTANCE) -> str | None:
+        if not fingerprint:
+            return None
+        duration = fingerprint["duration"]
+        seconds = range(math.floor(duration - DURATION_TOLERANCE_SECONDS),
+                        math.floor(duration + DURATION_TOLERANCE_SECONDS) + 1)
+        with self._lock:
+            candidates = [known for second in seconds for known in self._by_duration.get(second, [])]
+        for name, known in candidates:
+            if fingerprint_distance(fingerprint, known) <= max_distance:
+                return name
+        return None
+
+    def record_duplicate(self, name: str, original: str, kind: str):
+        self._append({"name": name, "duplicate_of": original, "kind": kind})
+        logger.info(f"[DEDUP] {name} skipped as {kind} duplicate of {original}, stats: {self.stats}")
+
+    def record_skipped(self, name: str, reason: str):
+        self._append({"name": name, "skipped": reason})
+        logger.info(f"[DEDUP] {name} skipped: {reason}, stats: {self.stats}")
+
+    def add(self, name: str, md5: str | None, fingerprint: dict | None):
+        self._append({"name": name, "md5": md5, "fingerprint": fingerprint})
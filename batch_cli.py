@@ -0,0 +1,130 @@
+"""
+Offline batch processing of a local directory of recordings, without Google Drive and Sheets.
+
+    python batch_cli.py <input_dir> <output.jsonl> [--workers 2] [--keep-transcripts] [--no-store]
+
+Every recording is transcribed and analysed in a process pool; one JSON line with the same
+fields main.start pushes to the daily report is appended per call, with "source" being the
+recording's path relative to input_dir. Re-running with the same output file skips recordings
+that already have a record.
+"""
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from config import AUDIO_EXTENSIONS, TRANSCRIPTS_DIR
+from loguru import logger
+
+
+def find_recordings(input_dir: Path) -> list[Path]:
+    return sorted(p for p in input_dir.rglob("*") if p.is_file() and p.suffix and p.suffix.lower() in AUDIO_EXTENSIONS)
+
+
+def load_done(output_path: Path) -> set[str]:
+    done = set()
+    if not output_path.exists():
+        return done
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["source"])
+            except (json.JSONDecodeError, KeyError):
+                # Оборванная последняя строка после падения — файл будет обработан заново
+                continue
+    return done
+
+
+def source_key(audio_path: Path, input_dir: Path) -> str:
+    # Путь относительно input_dir: не зависит от того, как input_dir записан в командной строке,
+    # и различает записи с одинаковым именем в разных подпапках
+    return audio_path.relative_to(input_dir).as_posix()
+
+
+def transcript_folder(source: str) -> Path:
+    return TRANSCRIPTS_DIR / Path(source).parent
+
+
+def process_recording(audio_path: str, source: str, keep_transcripts: bool = False) -> dict:
+    # Импорты внутри воркера: ML зависимости грузятся только в процессах пула
+    from transcribe_audio import process_audio_file
+    from call_analysis import process_transcript
+    from google_sheets_reports import build_daily_report
+
+    path = Path(audio_path)
+    transcript = process_audio_file(path, output_folder=transcript_folder(source))
+    result = process_transcript(transcript)
+    if not keep_transcripts:
+        for artifact in transcript.artifacts:
+            artifact.unlink(missing_ok=True)
+
+    return {
+        "source": source,
+        "audio_seconds": transcript.segments[-1].end if transcript.segments else 0.0,
+        **build_daily_report(result, path),
+    }
+
+
+def run_batch(input_dir: Path, output_path: Path, workers: int, keep_transcripts: bool, store: bool = True):
+    recordings = find_recordings(input_dir)
+    done = load_done(output_path)
+    todo = [p for p in recordings if source_key(p, input_dir) not in done]
+    logger.info(f"{len(recordings)} recordings found, {len(recordings) - len(todo)} already in {output_path}, "
+                f"{len(todo)} to process with {workers} workers")
+    if not todo:
+        return
+
+    analytics_store = None
+    if store:
+        from analytics_store import get_analytics_store
+        analytics_store = get_analytics_store()
+
+    started = time.perf_counter()
+    processed, failed, audio_seconds = 0, 0, 0.0
+    # spawn: torch и CUDA не переживают fork
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool, \
+            open(output_path, "a", encoding="utf-8") as out:
+        futures = {
+            pool.submit(process_recording, str(path), source_key(path, input_dir), keep_transcripts): path
+            for path in todo
+        }
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                if analytics_store is not None:
+                    analytics_store.add(record, record["source"])
+                processed += 1
+                audio_seconds += record["audio_seconds"]
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error while processing {futures[future]}: {e}")
+
+            elapsed = time.perf_counter() - started
+            print(
+                f"\r{processed + failed}/{len(todo)} done, {failed} failed | "
+                f"{processed / elapsed * 60:.1f} calls/min, {audio_seconds / elapsed:.1f}x realtime",
+                end="", file=sys.stderr, flush=True,
+            )
+    print(file=sys.stderr)
+    logger.info(f"Batch finished: {processed} processed, {failed} failed in {time.perf_counter() - started:.0f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe and analyse a local directory of call recordings")
+    parser.add_argument("input_dir", type=Path)
+    parser.add_argument("output", type=Path, help="JSONL file with one record per call; used to resume")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--keep-transcripts", action="store_true", help="keep .txt transcripts in transcribed_files, mirroring input subdirectories")
+    parser.add_argument("--no-store", action="store_true", help="do not write results to the local analytics store")
+    args = parser.parse_args()
+
+    run_batch(args.input_dir, args.output, args.workers, args.keep_transcripts, store=not args.no_store)
+
+
+if __name__ == "__main__":
+    main()
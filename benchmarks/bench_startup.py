@@ -0,0 +1,53 @@
+"""
+Import time of `main` with lazy ML imports versus the previous eager behaviour.
+
+    python benchmarks/bench_startup.py [--runs 5]
+
+"before" pre-imports whisperx, torch, resemblyzer and sklearn the way main.py used to pull them in
+through transcribe_audio; "after" imports main alone. Each measurement is a fresh interpreter.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+HEAVY_MODULES = ["whisperx", "torch", "resemblyzer", "sklearn"]
+
+SCENARIOS = {
+    "before": "import whisperx, torch, resemblyzer, sklearn.cluster\nimport main",
+    "after": "import main",
+}
+
+CHECK_LAZY = (
+    "import sys, main\n"
+    f"loaded = [m for m in {HEAVY_MODULES!r} if m in sys.modules]\n"
+    "print(','.join(loaded))"
+)
+
+
+def measure(code: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, code in SCENARIOS.items():
+        timings = [measure(code) for _ in range(args.runs)]
+        print(f"{name:>7}: median {statistics.median(timings):.2f}s, min {min(timings):.2f}s over {args.runs} runs")
+
+    loaded = subprocess.run([sys.executable, "-c", CHECK_LAZY], cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout.strip()
+    print(f"heavy modules loaded by `import main`: {loaded or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
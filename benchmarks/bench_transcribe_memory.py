@@ -0,0 +1,71 @@
+"""
+Peak RSS of full vs chunked transcription for synthetic recordings of 5, 30 and 120 minutes.
+
+    python benchmarks/bench_transcribe_memory.py [--minutes 5 30 120] [--chunk-seconds 60]
+
+Each run happens in a fresh subprocess so ru_maxrss belongs to that run only.
+Speaker role detection (Ollama) is disabled in the child, only decoding, diarization and ASR are measured.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHILD = """
+import sys
+from pathlib import Path
+import transcribe_audio
+transcribe_audio.get_speaker_roles = lambda dialog_text: {}
+audio_path, mode = Path(sys.argv[1]), sys.argv[2]
+if mode == "chunked":
+    transcribe_audio.process_audio_file_chunked(audio_path, chunk_seconds=float(sys.argv[3]))
+else:
+    # Не process_audio_file: он сам уходит в чанковый режим, если TRANSCRIBE_CHUNK_SECONDS > 0
+    transcribe_audio.process_audio_file_full(audio_path, mode="online")
+"""
+
+
+def make_recording(path: Path, minutes: int):
+    # Два "голоса" с паузами: чередующиеся тоны разной высоты с шумом
+    duration = minutes * 60
+    expr = "0.3*sin(2*PI*(180+120*gte(mod(t,8),4))*t)*gte(mod(t,4),0.5)+0.02*(random(0)-0.5)"
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i",
+         f"aevalsrc='{expr}':s=16000:d={duration}", "-ac", "1", "-b:a", "64k", str(path)],
+        check=True,
+    )
+
+
+def run(audio_path: Path, mode: str, chunk_seconds: float):
+    started = time.time()
+    proc = subprocess.Popen([sys.executable, "-c", CHILD, str(audio_path), mode, str(chunk_seconds)], cwd=ROOT)
+    _, status, usage = os.wait4(proc.pid, 0)
+    if status != 0:
+        raise RuntimeError(f"{mode} run failed for {audio_path.name}")
+    # ru_maxrss в килобайтах на Linux
+    return usage.ru_maxrss / 1024, time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=int, nargs="+", default=[5, 30, 120])
+    parser.add_argument("--chunk-seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    print(f"{'minutes':>8} {'mode':>8} {'peak RSS, MB':>14} {'time, s':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in args.minutes:
+            audio_path = Path(tmp) / f"bench_{minutes}min.mp3"
+            make_recording(audio_path, minutes)
+            for mode in ("full", "chunked"):
+                peak_mb, elapsed = run(audio_path, mode, args.chunk_seconds)
+                print(f"{minutes:>8} {mode:>8} {peak_mb:>14.0f} {elapsed:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
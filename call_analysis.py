@@ -1,13 +1,25 @@
 import re
-import requests
 import json
 import time
 from collections import Counter
-from config import MODEL_URL, MODEL_NAME, TEMPERATURE, MAX_SEGMENT_LENGTH
+from transcript import Transcript
+from config import MODEL_NAME, TEMPERATURE, LLM_MAX_TOKENS, LLM_CONTEXT_TOKENS, LLM_CHARS_PER_TOKEN, \
+    WORK_RESPONSE_TOKENS, WORK_PRIORITIZE_CLIENT
+from ollama_pool import ollama_pool
 from loguru import logger
 
 
-def get_speaker_roles(dialog_text: str, model_url=MODEL_URL, model_name=MODEL_NAME):
+def llm_options() -> dict:
+    # Ollama читает параметры генерации только из options
+    return {"temperature": float(TEMPERATURE or 0), "num_predict": LLM_MAX_TOKENS, "num_ctx": LLM_CONTEXT_TOKENS}
+
+
+def dialog_message(dialog_text: str) -> str:
+    # Инструкции уходят отдельным system сообщением: одинаковый префикс у всех звонков попадает в кэш
+    return "Диалог для анализа:\n" + dialog_text
+
+
+def get_speaker_roles(dialog_text: str, model_name=MODEL_NAME):
     system_prompt = """
         Ты — профессиональный аналитик телефонных звонков автосервиса. 
         Твоя задача — анализировать расшифровку разговора между Клиентом и Менеджером и давать точный структурированный отчёт.
@@ -25,23 +37,15 @@ def get_speaker_roles(dialog_text: str, model_url=MODEL_URL, model_name=MODEL_NA
           "Speaker 2": "Клиент или Менеджер"
         }
         
+        Если в диалоге только один Speaker — верни только его. Если есть Speaker 3 и далее — добавь их так же.
+        
         НИЧЕГО ЛИШНЕГО ПИСАТЬ НЕ НАДО, ТОЛЬКО JSON.
     """
 
-    prompt = system_prompt + "\n\nДиалог для анализа:\n" + dialog_text
-
-    response = requests.post(
-        model_url,
-        json={
-            "model": model_name,
-            "prompt": prompt,
-            "stream": False
-        }
+    data = ollama_pool.chat_stream(
+        system_prompt, dialog_message(dialog_text), llm_options(), label="Roles", model=model_name
     )
 
-    response.raise_for_status()
-    data = response.json()
-
     text = data.get("response") or data.get("text") or ""
 
     clean_text = re.sub(r'^```json\s*', '', text)  # Убираем начало
@@ -156,6 +160,31 @@ system_prompt_2 = """
 Не пиши ничего вне JSON.
 """
 
+WORK_KEY = "Яка робота з топ 100"
+CLIENT_SPEAKER = "Клиент"
+
+# Ключи, после получения которых генерацию можно останавливать
+PROMPT_KEYS = {
+    "Prompt 1": [
+        "Початок розмови, представлення",
+        "Чи дізнвся менеджер кузов атвомобіля",
+        "Чи дізнався менеджер рік автомобіля",
+        "Чи дізнався менеджр пробіг",
+        "Пропозиція про комплексну діагностику",
+        "Дізнався які роботи робилися раніше",
+        "Запис на сервіс, Дата",
+        "Завершення розмови прощання",
+        "Коментарий",
+        "Тип звернення",
+    ],
+    "Prompt 2": [
+        "Чи дотримувався всіх інструкцій з топ 100 робіт Да/Ні",
+        "Яких рекоменадцій менеджер не дотримувався з топ 100 робіт",
+        "Результат",
+        "Запчастини",
+    ],
+}
+
 
 work_list = [
  "інший варіант",
@@ -244,18 +273,8 @@ work_list = [
 ]
 
 
-def split_text(text, max_len=MAX_SEGMENT_LENGTH):
-    segments = []
-    start = 0
-    while start < len(text):
-        end = min(len(text), start + max_len)
-        segments.append(text[start:end])
-        start = end
-    return segments
-
-
-def analyze_segment(segment, work_list):
-    system_prompt = f"""
+def work_system_prompt(work_list):
+    return f"""
 Твоя задача – проанализировать диалог между клиентом и менеджером.
 Выбери только одну работу из списка, которая соответствует обсуждённым проблемам в диалоге.
 
@@ -269,25 +288,102 @@ def analyze_segment(segment, work_list):
 — Начни ответ строго с {{ и закончи }}.
 """
 
-    prompt = system_prompt + "\n\nДиалог для анализа:\n" + segment
 
-    response = requests.post(
-        MODEL_URL,
-        json={
-            "model": MODEL_NAME,
-            "prompt": prompt,
-            "temperature": TEMPERATURE,
-            "max_new_tokens": 2000,
-            "stream": False
-        }
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / LLM_CHARS_PER_TOKEN) + 1
+
+
+def work_dialog_budget() -> int:
+    """Tokens left for the dialog in a work classification call after the instructions and the answer."""
+    prompt_tokens = estimate_tokens(work_system_prompt(work_list) + dialog_message(""))
+    return max(LLM_CONTEXT_TOKENS - prompt_tokens - WORK_RESPONSE_TOKENS, 1)
+
+
+def dialog_turns(transcript: Transcript) -> list[tuple[str, list[str]]]:
+    """Groups consecutive segments of the same speaker into turns: [(speaker, lines)]."""
+    turns = []
+    for seg in transcript.segments:
+        if turns and turns[-1][0] == seg.speaker:
+            turns[-1][1].append(seg.to_line())
+        else:
+            turns.append((seg.speaker, [seg.to_line()]))
+    return turns
+
+
+def split_long_line(line: str, budget: int) -> list[str]:
+    parts, current = [], ""
+    for word in line.split(" "):
+        candidate = f"{current} {word}" if current else word
+        if current and estimate_tokens(candidate) > budget:
+            parts.append(current)
+            current = word
+        else:
+            current = candidate
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_turns(transcript: Transcript, budget: int, prioritize_client: bool = WORK_PRIORITIZE_CLIENT) -> list[str]:
+    """
+    Packs whole speaker turns into as few chunks of at most `budget` tokens as possible.
+    A turn is only split (on line, then word boundaries) when it alone exceeds the budget.
+    If the dialog does not fit into one chunk and prioritize_client is set, only the client's
+    turns, where the problem is described, are sent.
+    """
+    turns = dialog_turns(transcript)
+    if prioritize_client and estimate_tokens(transcript.to_text()) > budget:
+        client_turns = [turn for turn in turns if turn[0] == CLIENT_SPEAKER]
+        if client_turns:
+            turns = client_turns
+
+    chunks, current, current_tokens = [], [], 0
+
+    def add_line(line, tokens):
+        nonlocal current, current_tokens
+        if current and current_tokens + tokens > budget:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+
+    for _, lines in turns:
+        turn_tokens = estimate_tokens("\n".join(lines))
+        if turn_tokens <= budget:
+            # Переносим ход целиком, чтобы не резать реплику между чанками
+            if current and current_tokens + turn_tokens > budget:
+                chunks.append("\n".join(current))
+                current, current_tokens = [], 0
+            current.extend(lines)
+            current_tokens += turn_tokens
+            continue
+
+        for line in lines:
+            line_tokens = estimate_tokens(line)
+            if line_tokens <= budget:
+                add_line(line, line_tokens)
+            else:
+                for part in split_long_line(line, budget):
+                    add_line(part, estimate_tokens(part))
+
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def analyze_segment(segment, work_list):
+    data = ollama_pool.chat_stream(
+        work_system_prompt(work_list), dialog_message(segment), llm_options(),
+        expected_keys=[WORK_KEY], label="Prompt 3",
     )
-    data = response.json()
     answer = data.get("response", "").strip()
     return answer
 
 def execute_prompt(prompt_name, system_prompt, dialog_text, additional_params=None):
     if prompt_name == "Prompt 3":
-        segments =  split_text(dialog_text)
+        transcript = (additional_params or {}).get("transcript") or Transcript.from_text("dialog", dialog_text)
+        segments = split_turns(transcript, work_dialog_budget())
+        logger.info(f"Work classification: {len(segments)} chunk(s) for {len(transcript.segments)} segments")
         results = []
         for seg in segments:
             try:
@@ -299,22 +395,13 @@ def execute_prompt(prompt_name, system_prompt, dialog_text, additional_params=No
                 results.append("інший варіант")
 
         counter = Counter(results)
-        final_choice = counter.most_common(1)[0][0]
+        final_choice = counter.most_common(1)[0][0] if counter else "інший варіант"
         result = {"Яка робота з топ 100": final_choice}
     else:
-        prompt = system_prompt + "\n\nДиалог для анализа:\n" + dialog_text
-
-        response = requests.post(
-            MODEL_URL,
-            json={
-                "model": MODEL_NAME,
-                "prompt": prompt,
-                "temperature": TEMPERATURE,
-                "max_new_tokens": 2000,
-                "stream": False
-            }
+        data = ollama_pool.chat_stream(
+            system_prompt, dialog_message(dialog_text), llm_options(),
+            expected_keys=PROMPT_KEYS.get(prompt_name, ()), label=prompt_name,
         )
-        data = response.json()
         result = data.get("response", "").strip()
 
     return result
@@ -339,15 +426,13 @@ def clean_json_text(text: str) -> str:
 
 
 def process_transcript_file(file_path):
-    dialog_lines = []
-    with open(file_path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                dialog_lines.append(line)
-    dialog_text = "\n".join(dialog_lines)
+    return process_transcript(Transcript.from_text_file(file_path))
+
+
+def process_transcript(transcript: Transcript):
+    dialog_text = transcript.to_text()
 
-    manager_found = any("Менеджер:" in line for line in dialog_lines)
+    manager_found = transcript.has_speaker("Менеджер")
 
     if not manager_found:
         combined_results = [
@@ -379,7 +464,7 @@ def process_transcript_file(file_path):
 
     result1 = execute_prompt("Prompt 1", system_prompt_1, dialog_text)
     result2 = execute_prompt("Prompt 2", system_prompt_2, dialog_text)
-    result3 = execute_prompt("Prompt 3", "", dialog_text)
+    result3 = execute_prompt("Prompt 3", "", dialog_text, {"transcript": transcript})
 
     combined_results = [
         json.loads(clean_json_text(result1)),
@@ -0,0 +1,19 @@
+from datetime import date, datetime
+from pathlib import Path
+
+# Форматы даты в начале имени файла записи: "<дата>_<...>_<телефон>.mp3"
+DATE_FORMATS = ["%Y-%m-%d", "%Y%m%d", "%d.%m.%Y", "%d-%m-%Y"]
+
+
+def parse_call_date(value: str) -> date | None:
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def call_date_from_name(file_name: str) -> date | None:
+    # Дата — первая часть имени, как в extract_date_and_phone, но без логирования нераспознанных имён
+    return parse_call_date(Path(file_name).stem.split("_")[0])
@@ -8,13 +8,58 @@ AUDIO_EXTENSIONS = os.getenv("AUDIO_EXTENSIONS")
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR")
 CLIENT_SECRET_FILE = Path(os.getenv("CLIENT_SECRET_FILE"))
 TOKEN_FILE = Path(os.getenv("TOKEN_FILE"))
+TRANSCRIPTS_DIR = Path("transcribed_files")
 # Ollama настройки
 MODEL_URL = os.getenv("MODEL_URL")
 MODEL_NAME = os.getenv("MODEL_NAME")
 TEMPERATURE = os.getenv("TEMPERATURE")
 REDIRECT_URI = "http://localhost:8000/auth/callback"
-MAX_SEGMENT_LENGTH = int(os.getenv("MAX_SEGMENT_LENGTH"))
 SCOPES_SHEETS = ["https://www.googleapis.com/auth/spreadsheets"]
 SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE")
 SHEET_ID = os.getenv("SHEET_ID")
-SHEET_NAME = os.getenv("SHEET_NAME")
\ No newline at end of file
+SHEET_NAME = os.getenv("SHEET_NAME")
+# Диаризация
+DIARIZATION_MODE = os.getenv("DIARIZATION_MODE", "online")
+DIARIZATION_WINDOW_SECONDS = float(os.getenv("DIARIZATION_WINDOW_SECONDS", "1.5"))
+SILENCE_THRESHOLD_DBFS = float(os.getenv("SILENCE_THRESHOLD_DBFS", "-45"))
+SPEAKER_SIMILARITY_THRESHOLD = float(os.getenv("SPEAKER_SIMILARITY_THRESHOLD", "0.75"))
+MAX_SPEAKERS = int(os.getenv("MAX_SPEAKERS", "4"))
+MIN_SPEAKER_SHARE = float(os.getenv("MIN_SPEAKER_SHARE", "0.1"))
+# Потоковая транскрибация длинных записей (0 — выключено)
+TRANSCRIBE_CHUNK_SECONDS = float(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "0"))
+TRANSCRIBE_CHUNK_OVERLAP_SECONDS = float(os.getenv("TRANSCRIBE_CHUNK_OVERLAP_SECONDS", "5"))
+ROLE_SAMPLE_SEGMENTS = int(os.getenv("ROLE_SAMPLE_SEGMENTS", "40"))
+# Дедупликация записей
+FINGERPRINT_INDEX_FILE = os.getenv("FINGERPRINT_INDEX_FILE", "fingerprint_index.jsonl")
+FINGERPRINT_MAX_DISTANCE = float(os.getenv("FINGERPRINT_MAX_DISTANCE", "0.15"))
+TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+# Загрузка результатов в Drive
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "20"))
+MULTIPART_UPLOAD_MAX_BYTES = int(os.getenv("MULTIPART_UPLOAD_MAX_BYTES", str(5 * 1024 * 1024)))
+# Бюджет диска для скачанного аудио
+WORKSPACE_BUDGET_BYTES = int(os.getenv("WORKSPACE_BUDGET_BYTES", str(2 * 1024 ** 3)))
+WORKSPACE_DEFAULT_FILE_BYTES = int(os.getenv("WORKSPACE_DEFAULT_FILE_BYTES", str(20 * 1024 ** 2)))
+# Пул Ollama: через запятую, по умолчанию — сервер из MODEL_URL
+OLLAMA_URLS = [
+    url.strip() for url in (os.getenv("OLLAMA_URLS") or (MODEL_URL or "").split("/api/")[0]).split(",") if url.strip()
+]
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "15"))
+OLLAMA_SLOW_SECONDS = float(os.getenv("OLLAMA_SLOW_SECONDS", "2"))
+OLLAMA_MAX_FAILURES = int(os.getenv("OLLAMA_MAX_FAILURES", "3"))
+OLLAMA_REQUEST_TIMEOUT = float(os.getenv("OLLAMA_REQUEST_TIMEOUT", "300"))
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", "2000"))
+LLM_EARLY_STOP = os.getenv("LLM_EARLY_STOP", "true").lower() in ("1", "true", "yes")
+LLM_TAIL_SAMPLE_EVERY = int(os.getenv("LLM_TAIL_SAMPLE_EVERY", "20"))
+# Разбиение диалога для классификации работ
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "4096"))
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "2.5"))
+WORK_RESPONSE_TOKENS = int(os.getenv("WORK_RESPONSE_TOKENS", "64"))
+WORK_PRIORITIZE_CLIENT = os.getenv("WORK_PRIORITIZE_CLIENT", "true").lower() in ("1", "true", "yes")
+ANALYTICS_DB_FILE = os.getenv("ANALYTICS_DB_FILE", "analytics.db")
+# Планировщик нескольких папок-источников (по одной на филиал)
+SOURCES_FILE = os.getenv("SOURCES_FILE", "sources.json")
+SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", "300"))
+SCHEDULER_PROCESS_WORKERS = int(os.getenv("SCHEDULER_PROCESS_WORKERS", "1"))
+SCHEDULER_MAX_DOWNLOAD_ATTEMPTS = int(os.getenv("SCHEDULER_MAX_DOWNLOAD_ATTEMPTS", "3"))
@@ -0,0 +1,104 @@
+import json
+import asyncio
+import aiohttp
+from datetime import datetime, timedelta
+from pathlib import Path
+from google.oauth2.credentials import Credentials
+from config import TOKEN_FILE, TOKEN_REFRESH_MARGIN_SECONDS
+from loguru import logger
+
+
+class DriveCredentials:
+    """
+    OAuth credentials shared by Drive downloads, uploads and get_drive_service.
+    The access token is refreshed ahead of expiry exactly once under an asyncio lock,
+    without blocking the event loop, and persisted to TOKEN_FILE.
+    """
+
+    def __init__(self, token_file: Path = TOKEN_FILE, refresh_margin: float = TOKEN_REFRESH_MARGIN_SECONDS):
+        self.token_file = token_file
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._data: dict | None = None
+        self._google: Credentials | None = None
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        if not self.token_file.exists():
+            raise RuntimeError("No token file. Please go through it first. /auth/google и /auth/callback")
+
+        with self.token_file.open("r", encoding="utf-8") as f:
+            self._data = json.load(f)
+
+        expiry = self._data.get("expiry")
+        self._google = Credentials(
+            token=self._data["token"],
+            refresh_token=self._data.get("refresh_token"),
+            token_uri=self._data["token_uri"],
+            client_id=self._data["client_id"],
+            client_secret=self._data["client_secret"],
+            scopes=self._data["scopes"],
+        )
+        # google-auth ожидает naive UTC datetime
+        self._google.expiry = datetime.fromisoformat(expiry.rstrip("Z")) if expiry else None
+
+    @property
+    def google_credentials(self) -> Credentials:
+        if self._google is None:
+            self.load()
+        return self._google
+
+    @property
+    def token(self) -> str:
+        return self.google_credentials.token
+
+    def _expires_soon(self) -> bool:
+        expiry = self.google_credentials.expiry
+        return expiry is not None and datetime.utcnow() >= expiry - self.refresh_margin
+
+    async def get_token(self) -> str:
+        if self._expires_soon():
+            await self.refresh(stale_token=self.token)
+        return self.token
+
+    async def refresh(self, stale_token: str | None = None) -> str:
+        """
+        Refreshes the access token. Callers pass the token they saw fail (or expire);
+        if another task already replaced it while waiting for the lock, no extra refresh is made.
+        """
+        async with self._lock:
+            if stale_token is not None and self.token != stale_token:
+                return self.token
+
+            creds = self.google_credentials
+            data = {
+                "client_id": creds.client_id,
+                "client_secret": creds.client_secret,
+                "refresh_token": creds.refresh_token,
+                "grant_type": "refresh_token",
+            }
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(creds.token_uri, data=data) as resp:
+                        resp.raise_for_status()
+                        payload = await resp.json()
+            except Exception as e:
+                logger.error(f"[ERROR] Failed to refresh access token: {e}")
+                raise e
+
+            creds.token = payload["access_token"]
+            creds.expiry = datetime.utcnow() + timedelta(seconds=payload.get("expires_in", 3600))
+            self._data["token"] = creds.token
+            self._data["expiry"] = creds.expiry.isoformat() + "Z"
+            await asyncio.to_thread(self._persist)
+
+            logger.info(f"[INFO] Access token refreshed, valid until {self._data['expiry']}")
+            return creds.token
+
+    def _persist(self):
+        tmp_path = self.token_file.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as f:
+            json.dump(self._data, f, indent=4)
+        tmp_path.replace(self.token_file)
+
+
+drive_credentials = DriveCredentials()
@@ -1,69 +1,27 @@
-import json
+import time
 import aiohttp
 import asyncio
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from googleapiclient.http import MediaFileUpload
-from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from config import TOKEN_FILE, AUDIO_EXTENSIONS
+from config import AUDIO_EXTENSIONS, UPLOAD_WORKERS, MULTIPART_UPLOAD_MAX_BYTES
+from drive_credentials import DriveCredentials, drive_credentials
 from loguru import logger
 
-def get_drive_service():
-    try:
-        if not TOKEN_FILE.exists():
-            raise RuntimeError("No token file. Please go through it first. /auth/google и /auth/callback")
-
-        with TOKEN_FILE.open("r", encoding="utf-8") as f:
-            token_data = json.load(f)
-
-        creds = Credentials(
-            token=token_data["token"],
-            refresh_token=token_data.get("refresh_token"),
-            token_uri=token_data["token_uri"],
-            client_id=token_data["client_id"],
-            client_secret=token_data["client_secret"],
-            scopes=token_data["scopes"],
-        )
+# Клиент googleapiclient не потокобезопасен: у каждого потока загрузки свой сервис
+_upload_local = threading.local()
+_upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="drive-upload")
 
-        service = build("drive", "v3", credentials=creds)
+def get_drive_service(credentials: DriveCredentials = drive_credentials):
+    try:
+        service = build("drive", "v3", credentials=credentials.google_credentials)
         return service
     except Exception as e:
         logger.error(f"[ERROR] Failed to get drive service: {e}")
         raise e
 
-def refresh_access_token(client_id, client_secret, refresh_token):
-    try:
-        url = "https://oauth2.googleapis.com/token"
-        data = {
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "refresh_token": refresh_token,
-            "grant_type": "refresh_token"
-        }
-        r = requests.post(url, data=data)
-        r.raise_for_status()
-        return r.json()["access_token"]
-
-        cred_path = Path(TOKEN_FILE)
-
-        with open(cred_path, "r", encoding="utf-8") as f:
-            creds = json.load(f)
-
-        new_token = refresh_access_token(
-            creds["client_id"],
-            creds["client_secret"],
-            creds["refresh_token"]
-        )
-        creds["token"] = new_token
-
-        with open(cred_path, "w", encoding="utf-8") as f:
-            json.dump(creds, f, indent=4)
-
-    except Exception as e:
-        logger.error(f"[ERROR] Failed to refresh access token: {e}")
-        return None
-
 def list_items_in_folder(service, folder_id):
     try:
         items = []
@@ -72,7 +30,7 @@ def list_items_in_folder(service, folder_id):
         while True:
             resp = service.files().list(
                 q=f"'{folder_id}' in parents and trashed=false",
-                fields="nextPageToken, files(id, name, mimeType)",
+                fields="nextPageToken, files(id, name, mimeType, md5Checksum, size)",
                 pageToken=page_token,
                 includeItemsFromAllDrives=True,
                 supportsAllDrives=True,
@@ -98,38 +56,47 @@ def is_audio_file(item):
     return ext in AUDIO_EXTENSIONS
 
 
-async def upload_file_aio(drive_service, file_path, folder_id):
-    try:
+def _upload_file_sync(file_path: Path, folder_id: str, credentials: DriveCredentials):
+    service = getattr(_upload_local, "drive", None)
+    if service is None:
+        service = _upload_local.drive = get_drive_service(credentials)
 
-        file_metadata = {
-            'name': file_path.name,
-            'parents': [folder_id]
-        }
+    file_metadata = {
+        'name': file_path.name,
+        'parents': [folder_id]
+    }
 
-        media = MediaFileUpload(file_path, resumable=True)
-        loop = asyncio.get_event_loop()
-        file = await loop.run_in_executor(
-            None,
-            lambda: drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, name'
-            ).execute()
-        )
+    # Небольшие текстовые файлы — одним multipart запросом вместо resumable сессии
+    resumable = file_path.stat().st_size > MULTIPART_UPLOAD_MAX_BYTES
+    media = MediaFileUpload(file_path, resumable=resumable)
+    return service.files().create(
+        body=file_metadata,
+        media_body=media,
+        fields='id, name'
+    ).execute()
+
+
+async def upload_file_aio(file_path, folder_id, credentials: DriveCredentials = drive_credentials):
+    try:
+        # Обновляем токен заранее в event loop, чтобы клиент Drive не делал это блокирующе
+        await credentials.get_token()
+
+        loop = asyncio.get_running_loop()
+        file = await loop.run_in_executor(_upload_executor, _upload_file_sync, file_path, folder_id, credentials)
         return file
     except Exception as e:
         logger.error(f"[ERROR] Failed to upload file {file_path}: {e}")
         raise e
 
 
-async def download_file_drive_api(file_id: str, dest_path: Path, access_token: str,
-                                  client_id: str, client_secret: str, refresh_token: str):
+async def download_file_drive_api(file_id: str, dest_path: Path, credentials: DriveCredentials):
     try:
         dest_path.parent.mkdir(parents=True, exist_ok=True)
 
         url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
 
         for attempt in range(2):
+            access_token = await credentials.get_token()
             try:
                 headers = {"Authorization": f"Bearer {access_token}"}
                 async with aiohttp.ClientSession() as session:
@@ -158,7 +125,7 @@ async def download_file_drive_api(file_id: str, dest_path: Path, access_token: s
             except aiohttp.ClientResponseError as e:
                 if e.status == 401 and attempt == 0:
                     logger.info(f"[INFO] Access token expired, refreshing...")
-                    access_token = refresh_access_token(client_id, client_secret, refresh_token)
+                    await credentials.refresh(stale_token=access_token)
                 else:
                     logger.error(f"[ERROR] Failed to download {dest_path.name}: {e}")
                     return False
@@ -171,12 +138,16 @@ async def download_file_drive_api(file_id: str, dest_path: Path, access_token: s
 async def download_all_items_drive_api(
     items,
     dest_folder: Path,
-    access_token: str,
-    client_id: str,
-    client_secret: str,
-    refresh_token: str,
-    max_concurrent: int = 3
+    credentials: DriveCredentials = drive_credentials,
+    max_concurrent: int = 3,
+    workspace=None,
+    on_downloaded=None,
 ):
+    """
+    With a workspace, every download first reserves its Drive size in the workspace budget.
+    on_downloaded(path) is awaited as soon as a file is ready, so processing can start before
+    the whole folder is downloaded.
+    """
     try:
         semaphore = asyncio.Semaphore(max_concurrent)
         downloaded_files: list[Path] = []
@@ -188,11 +159,21 @@ async def download_all_items_drive_api(
                 filename = item["name"]
                 dest_path = dest_folder / filename
 
-                success = await download_file_drive_api(file_id, dest_path, access_token, client_id, client_secret, refresh_token)
+                if workspace is not None:
+                    await workspace.reserve(dest_path, int(item.get("size", 0)))
+
+                success = await download_file_drive_api(file_id, dest_path, credentials)
                 if success:
                     downloaded_files.append(dest_path)
+                    if workspace is not None:
+                        await workspace.commit(dest_path)
                 else:
                     skipped_files.append(dest_path)
+                    if workspace is not None:
+                        await workspace.release(dest_path)
+
+            if success and on_downloaded is not None:
+                await on_downloaded(dest_path)
 
         await asyncio.gather(*(sem_download(item) for item in items))
         return downloaded_files
@@ -200,17 +181,29 @@ async def download_all_items_drive_api(
         logger.error(f"[ERROR] Exception in download_all_items_drive_api: {e}")
         raise e
 
-async def upload_transcribed_files(drive_service, transcribed_files, folder_id):
-    try:
-        uploaded_items = []
-        for file_path in transcribed_files:
-            uploaded = await upload_file_aio(drive_service, Path(file_path), folder_id)
-            uploaded_items.append(uploaded)
-        return uploaded_items
+async def upload_transcribed_files(transcribed_files, folder_id, credentials: DriveCredentials = drive_credentials):
+    """
+    Uploads files concurrently. Returns one result per file in the same order:
+    the created Drive item, or the exception if that file failed to upload.
+    """
+    if not transcribed_files:
+        return []
 
-    except Exception as e:
-        logger.error(f"[ERROR] Failed to upload transcribed files: {e}")
-        raise e
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(upload_file_aio(Path(file_path), folder_id, credentials) for file_path in transcribed_files),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - started
+    failed = 0
+    for file_path, result in zip(transcribed_files, results):
+        if isinstance(result, BaseException):
+            failed += 1
+            logger.error(f"[ERROR] Failed to upload {file_path}: {result}")
+    uploaded = len(results) - failed
+    logger.info(f"[INFO] Uploaded {uploaded} files, {failed} failed in {elapsed:.2f}s "
+                f"({uploaded / max(elapsed, 1e-6):.1f} uploads/s)")
+    return results
 
 def create_folder(service, folder_name: str, parent_id: str | None = None) -> dict:
     try:
@@ -234,6 +227,28 @@ def create_folder(service, folder_name: str, parent_id: str | None = None) -> di
         raise e
 
 
+def get_or_create_folder(service, folder_name: str, parent_id: str | None = None) -> dict:
+    """Returns the existing folder with this name (under parent_id, if given) or creates it."""
+    try:
+        escaped_name = folder_name.replace("\\", "\\\\").replace("'", "\\'")
+        query = f"name = '{escaped_name}' and mimeType = 'application/vnd.google-apps.folder' and trashed = false"
+        if parent_id:
+            query += f" and '{parent_id}' in parents"
+        folders = service.files().list(
+            q=query,
+            fields="files(id, name, parents)",
+            includeItemsFromAllDrives=True,
+            supportsAllDrives=True,
+        ).execute().get("files", [])
+        if folders:
+            return folders[0]
+    except Exception as e:
+        logger.error(f"[ERROR] Failed to look up folder '{folder_name}': {e}")
+        raise e
+
+    return create_folder(service, folder_name, parent_id)
+
+
 def move_file_to_folder(service, file_item, target_folder_id):
     try:
         file_id = file_item["id"]
@@ -6,7 +6,7 @@ ollama serve &
 sleep 5
 
 # Подтягиваем модель
-ollama pull qwen2.5:3b
+ollama pull "${OLLAMA_MODEL:-qwen2.5:3b}"
 
 # Держим контейнер активным
 wait
@@ -3,6 +3,7 @@ from pathlib import Path
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from config import SCOPES_SHEETS, SERVICE_ACCOUNT_FILE, SHEET_ID, SHEET_NAME
+from transcribe_audio import yes_no_to_binary
 from loguru import logger
 
 
@@ -112,4 +113,31 @@ def extract_date_and_phone(file_path: Path):
         return date, phone
     except Exception as e:
         logger.error(f"Error: {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+def build_daily_report(result: list[dict], audio_path: Path, branch: str = "", manager: str = "") -> dict:
+    """Maps process_transcript results to push_daily_report arguments."""
+    date, phone = extract_date_and_phone(audio_path)
+    return {
+        "date": date,
+        "request_type": result[0].get("Тип звернення", "Інше"),
+        "phone": f"+380{phone}",
+        "branch": branch,
+        "manager": manager,
+        "intro": result[0].get("Початок розмови, представлення"),
+        "car_body_known": result[0].get("Чи дізнвся менеджер кузов атвомобіля"),
+        "car_year_known": result[0].get("Чи дізнався менеджер рік автомобіля"),
+        "mileage_known": result[0].get("Чи дізнався менеджр пробіг"),
+        "complex_diagnosis_offer": result[0].get("Пропозиція про комплексну діагностику"),
+        "previous_works_known": result[0].get("Дізнався які роботи робилися раніше"),
+        "service_date": result[0].get("Запис на сервіс, Дата"),
+        "farewell": result[0].get("Завершення розмови прощання"),
+        "top100_work": result[2].get("Яка робота з топ 100"),
+        "followed_all_instructions": yes_no_to_binary(
+            result[1].get("Чи дотримувався всіх інструкцій з топ 100 робіт Да/Ні")),
+        "which_recommendations_not_followed": result[1].get("Яких рекоменадцій менеджер не дотримувався з топ 100 робіт"),
+        "result": result[1].get("Результат", "Інше"),
+        "score": "",
+        "spare_parts": result[1].get("Запчастини", "Наші"),
+        "comment": result[0].get("Коментарий"),
+    }
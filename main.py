@@ -1,4 +1,6 @@
 import json
+import asyncio
+from collections import Counter, defaultdict
 from fastapi import FastAPI, Request
 from google_auth_oauthlib.flow import Flow
 from starlette.middleware.cors import CORSMiddleware
@@ -6,11 +8,19 @@ from starlette.responses import JSONResponse
 from loguru import logger
 from pathlib import Path
 from drive_file_manager import create_folder, move_audio_recursively, get_drive_service, \
-     upload_transcribed_files, download_all_items_drive_api
-from config import CLIENT_SECRET_FILE, REDIRECT_URI, TOKEN_FILE, WORKSPACE_DIR
-from call_analysis import process_transcript_file
-from google_sheets_reports import push_daily_report, extract_date_and_phone
-from transcribe_audio import process_audio_file, yes_no_to_binary
+     upload_transcribed_files, download_all_items_drive_api, download_file_drive_api, get_or_create_folder, \
+     list_items_in_folder, is_folder, is_audio_file
+from drive_credentials import drive_credentials
+from config import CLIENT_SECRET_FILE, REDIRECT_URI, TOKEN_FILE, WORKSPACE_DIR, UPLOAD_BATCH_SIZE, \
+    SCHEDULER_POLL_SECONDS, SCHEDULER_PROCESS_WORKERS, SCHEDULER_MAX_DOWNLOAD_ATTEMPTS
+from call_analysis import process_transcript, llm_options
+from google_sheets_reports import push_daily_report, build_daily_report
+from transcribe_audio import process_audio_file
+from audio_fingerprint import FingerprintIndex, compute_fingerprint
+from workspace import workspace
+from ollama_pool import ollama_pool
+from analytics_store import get_analytics_store
+from scheduler import FairScheduler, Source, load_sources
 
 logger.add("app_logs.log", rotation="10 MB", retention="7 days")
 
@@ -24,6 +34,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def cleanup_workspace():
+    workspace.cleanup_orphans()
+
+
+@app.on_event("startup")
+async def start_ollama_pool():
+    ollama_pool.start_health_checks()
+    # Прогрев в фоне, чтобы не задерживать старт API
+    app.state.ollama_warm_up = asyncio.create_task(asyncio.to_thread(ollama_pool.warm_up, llm_options()))
+
+
 @app.get("/auth/google")
 async def auth_google():
     try:
@@ -69,10 +91,12 @@ async def auth_callback(request: Request):
             "client_id": creds.client_id,
             "client_secret": creds.client_secret,
             "scopes": creds.scopes,
+            "expiry": creds.expiry.isoformat() + "Z" if creds.expiry else None,
         }
 
         with open(TOKEN_FILE, "w", encoding="utf-8") as f:
             json.dump(token_data, f, indent=4)
+        drive_credentials.load()
 
         return JSONResponse(status_code=200, content={"status": "ok"})
     except Exception as e:
@@ -80,76 +104,263 @@ async def auth_callback(request: Request):
         return JSONResponse(status_code=500, content={"result": str(e)})
 
 
+async def flush_uploads(pending_uploads: list[Path], folder_id: str):
+    # Забираем пачку сразу: пока идёт загрузка, другие воркеры могут добавлять новые файлы
+    batch = pending_uploads[:]
+    pending_uploads.clear()
+    try:
+        results = await upload_transcribed_files(batch, folder_id)
+    except Exception as e:
+        logger.error(f"Error while uploading transcripts: {e}")
+        pending_uploads.extend(batch)
+        return
+
+    for artifact, result in zip(batch, results):
+        if isinstance(result, BaseException):
+            # Остаётся в очереди и уйдёт со следующей пачкой
+            pending_uploads.append(artifact)
+        else:
+            artifact.unlink(missing_ok=True)
+
+
+def skip_md5_duplicates(items: list[dict], fingerprint_index: FingerprintIndex) -> list[dict]:
+    unique_items = []
+    for item in items:
+        original = fingerprint_index.find_by_md5(item.get("md5Checksum"))
+        if original == item["name"]:
+            # Тот же файл под тем же именем уже обработан — загружен повторно
+            fingerprint_index.record_duplicate(item["name"], original, "already_processed")
+        elif original:
+            fingerprint_index.record_duplicate(item["name"], original, "md5")
+        else:
+            unique_items.append(item)
+    return unique_items
+
+
+async def process_downloaded_file(audio_file: Path, fingerprint_index: FingerprintIndex, md5: str | None,
+                                  pending_uploads: list[Path], folder_id: str, branch: str = "") -> str:
+    """Returns the outcome: "processed", "skipped" (not mp3 or a duplicate) or "failed"."""
+    try:
+        if audio_file.suffix.lower() != ".mp3":
+            await asyncio.to_thread(fingerprint_index.record_skipped, audio_file.name, "not an mp3 file")
+            return "skipped"
+
+        fingerprint = await asyncio.to_thread(compute_fingerprint, audio_file)
+        original = await asyncio.to_thread(fingerprint_index.find_acoustic, fingerprint)
+        if original:
+            await asyncio.to_thread(fingerprint_index.record_duplicate, audio_file.name, original, "acoustic")
+            return "skipped"
+
+        transcript = await asyncio.to_thread(process_audio_file, audio_file)
+        await workspace.release(audio_file)
+
+        # Транскрипт ставим в очередь сразу: аудио уже удалено, и он не должен зависеть от успеха анализа
+        pending_uploads.extend(transcript.artifacts)
+        if len(pending_uploads) >= UPLOAD_BATCH_SIZE:
+            await flush_uploads(pending_uploads, folder_id)
+
+        result = await asyncio.to_thread(process_transcript, transcript)
+        report = build_daily_report(result, audio_file, branch=branch)
+        await asyncio.to_thread(push_daily_report, **report)
+        await asyncio.to_thread(get_analytics_store().add, report, audio_file.name)
+        await asyncio.to_thread(fingerprint_index.add, audio_file.name, md5, fingerprint)
+        return "processed"
+    except Exception as e:
+        logger.error(f"Error while processing {audio_file.name}: {e}")
+        return "failed"
+    finally:
+        await workspace.release(audio_file)
+
+
 @app.get("/start")
-async def start(request: Request, folder_id: str):
+async def start(request: Request, folder_id: str, branch: str = ""):
     try:
+        # Синхронный клиент Drive сам обновил бы токен в event loop, мимо общей блокировки и TOKEN_FILE
+        await drive_credentials.get_token()
         drive = get_drive_service()
         workspace_dir = Path(WORKSPACE_DIR)
 
         workspace_dir.mkdir(parents=True, exist_ok=True)
-        target_folder = create_folder(drive, WORKSPACE_DIR)
-        items = move_audio_recursively(drive, folder_id, target_folder['id'])
+        target_folder = await asyncio.to_thread(create_folder, drive, WORKSPACE_DIR)
+        await drive_credentials.get_token()
+        items = await asyncio.to_thread(move_audio_recursively, drive, folder_id, target_folder['id'])
 
-        with open("credentials.json", "r", encoding="utf-8") as f:
-            creds = json.load(f)
+        fingerprint_index = await asyncio.to_thread(FingerprintIndex)
+        unique_items = await asyncio.to_thread(skip_md5_duplicates, items, fingerprint_index)
+        md5_by_name = {item["name"]: item.get("md5Checksum") for item in unique_items}
 
-        access_token = creds.get("token")
-        refresh_token = creds.get("refresh_token")
-        client_id = creds.get("client_id")
-        client_secret = creds.get("client_secret")
-        downloaded_files = await download_all_items_drive_api(items, workspace_dir, access_token, client_id, client_secret, refresh_token)
+        # Скачивание и обработка идут параллельно: файл обрабатывается сразу после скачивания,
+        # а новые скачивания ждут свободного места в бюджете workspace
+        downloaded: asyncio.Queue = asyncio.Queue()
+        pending_uploads: list[Path] = []
 
-        for audio_file in downloaded_files:
+        async def download():
             try:
-                if audio_file.suffix.lower() != ".mp3":
-                    continue
-
-                transcribed_files = process_audio_file(audio_file)
-                audio_file.unlink()
-
-                await upload_transcribed_files(drive, transcribed_files, target_folder['id'])
-
-                for transcribed_file in transcribed_files:
-                    try:
-                        file_path = Path(transcribed_file)
-                        if file_path.suffix.lower() != ".txt":
-                            continue
-                        result = process_transcript_file(transcribed_file)
-                        date, phone = extract_date_and_phone(file_path)
-                        push_daily_report(
-                            date,
-                            result[0].get("Тип звернення", "Інше"),
-                            f"+380{phone}",
-                            "",
-                            "",
-                            result[0].get("Початок розмови, представлення"),
-                            result[0].get("Чи дізнвся менеджер кузов атвомобіля"),
-                            result[0].get("Чи дізнався менеджер рік автомобіля"),
-                            result[0].get("Чи дізнався менеджр пробіг"),
-                            result[0].get("Пропозиція про комплексну діагностику"),
-                            result[0].get("Дізнався які роботи робилися раніше"),
-                            result[0].get("Запис на сервіс, Дата"),
-                            result[0].get("Завершення розмови прощання"),
-                            result[2].get("Яка робота з топ 100"),
-                            yes_no_to_binary(result[1].get("Чи дотримувався всіх інструкцій з топ 100 робіт Да/Ні")),
-                            result[1].get("Яких рекоменадцій менеджер не дотримувався з топ 100 робіт"),
-                            result[1].get("Результат", "Інше"),
-                            "",
-                            result[1].get("Запчастини", "Наші"),
-                            result[0].get("Коментарий"),
-                        )
-                        file_path.unlink()
-                    except Exception as e:
-                        logger.error(f"Error while processing {transcribed_file.name}: {e}")
-            except Exception as e:
-                logger.error(f"Error while processing {audio_file.name}: {e}")
+                await download_all_items_drive_api(unique_items, workspace_dir, drive_credentials,
+                                                   workspace=workspace, on_downloaded=downloaded.put)
+            finally:
+                await downloaded.put(None)
+
+        download_task = asyncio.create_task(download())
+        while (audio_file := await downloaded.get()) is not None:
+            await process_downloaded_file(audio_file, fingerprint_index, md5_by_name.get(audio_file.name),
+                                          pending_uploads, target_folder['id'], branch)
+        await download_task
 
+        await flush_uploads(pending_uploads, target_folder['id'])
 
         return JSONResponse(status_code=200, content={"status": "ok"})
     except Exception as e:
         logger.error(f"Error in API endpoint /start : {e}")
         return JSONResponse(status_code=500, content={"result": str(e)})
 
+
+async def run_scheduler(scheduler: FairScheduler, outcomes: defaultdict[str, Counter]):
+    """
+    Continuously polls every source folder and processes their files in the scheduler's order.
+    Downloads, transcription and LLM workers are shared by all sources; the download queue holds
+    at most SCHEDULER_PROCESS_WORKERS files, so newly found calls of any branch are picked up quickly.
+    """
+    await drive_credentials.get_token()
+    drive = get_drive_service()
+    workspace_dir = Path(WORKSPACE_DIR)
+    fingerprint_index = await asyncio.to_thread(FingerprintIndex)
+    sources = list(scheduler.sources.values())
+    targets = {}
+    for source in sources:
+        folder_name = f"{WORKSPACE_DIR}_{source.branch or source.folder_id}"
+        folder = await asyncio.to_thread(get_or_create_folder, drive, folder_name)
+        targets[source.folder_id] = folder["id"]
+    pending_uploads: dict[str, list[Path]] = {s.folder_id: [] for s in sources}
+    downloaded: asyncio.Queue = asyncio.Queue(maxsize=SCHEDULER_PROCESS_WORKERS)
+    new_items = asyncio.Event()
+    failed_downloads: list[tuple[Source, dict]] = []
+    download_attempts: Counter = Counter()
+
+    # Очередь живёт только в памяти: после перезапуска подбираем перенесённые, но не обработанные файлы
+    for source in sources:
+        await drive_credentials.get_token()
+        items = await asyncio.to_thread(list_items_in_folder, drive, targets[source.folder_id])
+        items = [item for item in items if not is_folder(item) and is_audio_file(item)]
+        # Обработанные, дубликаты и пропущенные уже есть в индексе — повторно не считаем и не качаем
+        recovered = [item for item in items if not fingerprint_index.is_handled(item["name"])]
+        logger.info(f"[SCHEDULER] Branch {source.branch or source.folder_id}: {len(recovered)} unprocessed files "
+                    f"recovered, {len(items) - len(recovered)} already handled")
+        scheduler.enqueue(source, await asyncio.to_thread(skip_md5_duplicates, recovered, fingerprint_index))
+
+    async def poll():
+        while True:
+            # Неудачные скачивания повторяем раз за цикл опроса, чтобы не крутиться на одном файле
+            while failed_downloads:
+                scheduler.requeue(*failed_downloads.pop())
+                new_items.set()
+            for source in sources:
+                try:
+                    await drive_credentials.get_token()
+                    items = await asyncio.to_thread(move_audio_recursively, drive, source.folder_id,
+                                                    targets[source.folder_id])
+                    unique_items = await asyncio.to_thread(skip_md5_duplicates, items, fingerprint_index)
+                    if scheduler.enqueue(source, unique_items):
+                        new_items.set()
+                except Exception as e:
+                    logger.error(f"[SCHEDULER] Failed to poll branch {source.branch}: {e}")
+            await asyncio.sleep(SCHEDULER_POLL_SECONDS)
+
+    async def feed():
+        while True:
+            new_items.clear()
+            picked = scheduler.next()
+            if picked is None:
+                for folder_id, pending in pending_uploads.items():
+                    if pending:
+                        await flush_uploads(pending, folder_id)
+                await new_items.wait()
+                continue
+
+            source, item = picked
+            # У каждого источника своя папка: одинаковые имена файлов в разных филиалах не конфликтуют
+            dest_path = workspace_dir / source.folder_id / item["name"]
+            await workspace.reserve(dest_path, int(item.get("size", 0)))
+            if await download_file_drive_api(item["id"], dest_path, drive_credentials):
+                await workspace.commit(dest_path)
+                await downloaded.put((source, item, dest_path))
+            else:
+                await workspace.release(dest_path)
+                download_attempts[item["id"]] += 1
+                if download_attempts[item["id"]] < SCHEDULER_MAX_DOWNLOAD_ATTEMPTS:
+                    failed_downloads.append((source, item))
+                else:
+                    # Файл остаётся в целевой папке и будет подобран при следующем запуске планировщика
+                    logger.error(f"[SCHEDULER] Giving up on {item['name']} after "
+                                 f"{download_attempts[item['id']]} failed downloads")
+
+    async def worker():
+        while True:
+            source, item, audio_file = await downloaded.get()
+            outcome = await process_downloaded_file(audio_file, fingerprint_index, item.get("md5Checksum"),
+                                                    pending_uploads[source.folder_id], targets[source.folder_id],
+                                                    source.branch)
+            outcomes[source.branch or source.folder_id][outcome] += 1
+
+    await asyncio.gather(poll(), feed(), *(worker() for _ in range(SCHEDULER_PROCESS_WORKERS)))
+
+
+@app.get("/scheduler/start")
+async def scheduler_start():
+    try:
+        task = getattr(app.state, "scheduler_task", None)
+        if task is not None and not task.done():
+            return JSONResponse(status_code=200, content={"status": "already running"})
+
+        sources = load_sources()
+        app.state.scheduler = FairScheduler(sources)
+        app.state.scheduler_outcomes = defaultdict(Counter)
+        app.state.scheduler_task = asyncio.create_task(
+            run_scheduler(app.state.scheduler, app.state.scheduler_outcomes)
+        )
+        app.state.scheduler_task.add_done_callback(
+            lambda t: t.cancelled() or t.exception() is None
+            or logger.error(f"[SCHEDULER] Stopped with error: {t.exception()}")
+        )
+        return JSONResponse(status_code=200, content={"status": "ok", "sources": [s.branch for s in sources]})
+    except Exception as e:
+        logger.error(f"Error in API endpoint /scheduler/start : {e}")
+        return JSONResponse(status_code=500, content={"result": str(e)})
+
+
+@app.get("/scheduler/status")
+async def scheduler_status():
+    task = getattr(app.state, "scheduler_task", None)
+    if task is None:
+        return JSONResponse(status_code=200, content={"running": False})
+    return JSONResponse(status_code=200, content={
+        "running": not task.done(),
+        "pending": app.state.scheduler.pending(),
+        "outcomes": {branch: dict(counts) for branch, counts in app.state.scheduler_outcomes.items()},
+    })
+
+
+@app.get("/workspace")
+async def workspace_usage():
+    return JSONResponse(status_code=200, content=workspace.stats())
+
+
+@app.get("/reports/daily")
+async def reports_daily(date_from: str | None = None, date_to: str | None = None):
+    try:
+        report = await asyncio.to_thread(get_analytics_store().daily_report, date_from, date_to)
+        return JSONResponse(status_code=200, content={"days": report})
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"result": f"date_from and date_to must be YYYY-MM-DD: {e}"})
+    except Exception as e:
+        logger.error(f"Error in API endpoint /reports/daily : {e}")
+        return JSONResponse(status_code=500, content={"result": str(e)})
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+    return JSONResponse(status_code=200, content=ollama_pool.stats)
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,281 @@
+import json
+import time
+import threading
+import requests
+from contextlib import contextmanager
+from config import OLLAMA_URLS, MODEL_NAME, OLLAMA_KEEP_ALIVE, OLLAMA_HEALTH_INTERVAL, OLLAMA_SLOW_SECONDS, \
+    OLLAMA_MAX_FAILURES, OLLAMA_REQUEST_TIMEOUT, LLM_EARLY_STOP, LLM_TAIL_SAMPLE_EVERY
+from loguru import logger
+
+
+class JsonObjectScanner:
+    """
+    Incrementally scans streamed model output for the first complete top-level JSON object
+    that contains all expected keys.
+    """
+
+    def __init__(self, expected_keys=()):
+        self.expected_keys = set(expected_keys)
+        self.text = ""
+        self._pos = 0
+        self._start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, piece: str) -> str | None:
+        self.text += piece
+        while self._pos < len(self.text):
+            ch = self.text[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"' and self._start is not None:
+                self._in_string = True
+            elif ch == "{":
+                if self._start is None:
+                    self._start = self._pos - 1
+                self._depth += 1
+            elif ch == "}" and self._start is not None:
+                self._depth -= 1
+                if self._depth == 0:
+                    candidate = self.text[self._start:self._pos]
+                    self._start = None
+                    if self._matches(candidate):
+                        return candidate
+        return None
+
+    def _matches(self, candidate: str) -> bool:
+        try:
+            parsed = json.loads(candidate)
+        except json.JSONDecodeError:
+            return False
+        return isinstance(parsed, dict) and self.expected_keys <= parsed.keys()
+
+
+class OllamaBackend:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.latency = 0.0
+
+    def __repr__(self):
+        return f"OllamaBackend({self.url}, healthy={self.healthy}, outstanding={self.outstanding})"
+
+
+class OllamaPool:
+    """
+    Routes Ollama requests to the backend with the fewest outstanding requests.
+    Backends that fail OLLAMA_MAX_FAILURES requests in a row, or answer health checks slower than
+    OLLAMA_SLOW_SECONDS, are ejected until a health check succeeds again.
+    """
+
+    def __init__(self, urls: list[str], model_name: str = MODEL_NAME, keep_alive: str = OLLAMA_KEEP_ALIVE):
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.model_name = model_name
+        self.keep_alive = keep_alive
+        self._lock = threading.Lock()
+        self._health_thread: threading.Thread | None = None
+        self._calls = 0
+        self.stats: dict[str, dict] = {}
+
+    def _pick(self, exclude: set[str]) -> OllamaBackend | None:
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b.url not in exclude]
+            if not candidates:
+                # Все ноды выброшены — пробуем любую, лучше медленный ответ, чем никакого
+                candidates = [b for b in self.backends if b.url not in exclude]
+            if not candidates:
+                return None
+            backend = min(candidates, key=lambda b: (b.outstanding, b.latency))
+            backend.outstanding += 1
+            return backend
+
+    def _release(self, backend: OllamaBackend, ok: bool):
+        with self._lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.failures = 0
+                return
+            backend.failures += 1
+            if backend.healthy and backend.failures >= OLLAMA_MAX_FAILURES:
+                backend.healthy = False
+                logger.warning(f"[OLLAMA] Ejected {backend.url} after {backend.failures} failed requests")
+
+    @contextmanager
+    def _request(self, path: str, payload: dict, stream: bool = False):
+        """Sends the request to the least loaded backend, retrying the others on connection errors."""
+        payload = {"model": self.model_name, "keep_alive": self.keep_alive, **payload}
+        tried: set[str] = set()
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                raise RuntimeError(f"All Ollama backends failed for {path}")
+            tried.add(backend.url)
+            try:
+                response = requests.post(backend.url + path, json=payload, stream=stream,
+                                         timeout=OLLAMA_REQUEST_TIMEOUT)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                logger.error(f"[OLLAMA] Request to {backend.url}{path} failed: {e}")
+                self._release(backend, ok=False)
+                continue
+
+            # Обрыв соединения или битая строка NDJSON посреди ответа — тоже сбой ноды
+            ok = False
+            try:
+                yield response
+                ok = True
+            except Exception as e:
+                logger.error(f"[OLLAMA] Response from {backend.url}{path} failed: {e}")
+                raise
+            finally:
+                response.close()
+                self._release(backend, ok=ok)
+            return
+
+    def chat_stream(self, system: str, user: str, options: dict, expected_keys=(), label: str = "chat",
+                    model: str | None = None) -> dict:
+        """
+        Sends static instructions as the system message and the dialog as the user message, so every call
+        with the same instructions shares a prompt prefix the runtime can keep in its cache.
+        Streams the answer and closes the connection (which stops generation in Ollama) as soon as
+        a complete JSON object with expected_keys has been received. Returns {"response": text}.
+        """
+        payload = {
+            "messages": [{"role": "system", "content": system}, {"role": "user", "content": user}],
+            "options": options,
+            "stream": True,
+        }
+        if model:
+            payload["model"] = model
+
+        # Каждый LLM_TAIL_SAMPLE_EVERY-й вызов идёт до конца, чтобы измерить хвост после JSON
+        with self._lock:
+            self._calls += 1
+            sample_tail = LLM_TAIL_SAMPLE_EVERY > 0 and self._calls % LLM_TAIL_SAMPLE_EVERY == 0
+        early_stop = LLM_EARLY_STOP and not sample_tail
+
+        scanner = JsonObjectScanner(expected_keys)
+        started = time.perf_counter()
+        ttft = None
+        tokens = 0
+        answer_tokens = 0
+        answer = None
+        final = {}
+
+        with self._request("/api/chat", payload, stream=True) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    tokens += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    if answer is None:
+                        answer = scanner.feed(piece)
+                        answer_tokens = tokens
+                    if answer is not None and early_stop:
+                        break
+                if chunk.get("done"):
+                    final = chunk
+                    break
+
+        stopped_early = answer is not None and early_stop
+        # Хвост измерим только если ответ дошёл до конца: столько токенов пришло уже после закрытия JSON
+        tail_tokens = tokens - answer_tokens if answer is not None and final else None
+        self._record(label, ttft or 0.0, time.perf_counter() - started, tokens, stopped_early, tail_tokens,
+                     final.get("prompt_eval_count"))
+        return {"response": answer if answer is not None else scanner.text}
+
+    def _record(self, label: str, ttft: float, total: float, tokens: int, stopped_early: bool,
+                tail_tokens: int | None, prompt_eval_count: int | None):
+        with self._lock:
+            stats = self.stats.setdefault(label, {
+                "calls": 0, "early_stops": 0, "ttft_seconds_total": 0.0, "seconds_total": 0.0, "tokens_total": 0,
+                "tail_samples": 0, "tail_tokens_total": 0, "tokens_saved_estimate": 0,
+                "prompt_eval_calls": 0, "prompt_eval_tokens_total": 0,
+            })
+            stats["calls"] += 1
+            stats["early_stops"] += int(stopped_early)
+            stats["ttft_seconds_total"] += ttft
+            stats["seconds_total"] += total
+            stats["tokens_total"] += tokens
+            if tail_tokens is not None:
+                stats["tail_samples"] += 1
+                stats["tail_tokens_total"] += tail_tokens
+            # Экономия = ранние остановки * средний измеренный хвост
+            if stats["tail_samples"]:
+                stats["tokens_saved_estimate"] = round(
+                    stats["early_stops"] * stats["tail_tokens_total"] / stats["tail_samples"]
+                )
+            # Ollama присылает prompt_eval_count только в последнем чанке, при ранней остановке его нет
+            if prompt_eval_count is not None:
+                stats["prompt_eval_calls"] += 1
+                stats["prompt_eval_tokens_total"] += prompt_eval_count
+        logger.info(f"[LLM] {label}: ttft={ttft:.2f}s total={total:.2f}s tokens={tokens} "
+                    f"early_stop={stopped_early} tail_tokens={tail_tokens if tail_tokens is not None else 'n/a'} "
+                    f"prompt_eval_tokens={prompt_eval_count if prompt_eval_count is not None else 'n/a'}")
+
+    def check_health(self):
+        for backend in self.backends:
+            started = time.perf_counter()
+            try:
+                requests.get(backend.url + "/api/tags", timeout=OLLAMA_SLOW_SECONDS * 2).raise_for_status()
+                latency = time.perf_counter() - started
+                healthy = latency <= OLLAMA_SLOW_SECONDS
+            except requests.RequestException:
+                latency, healthy = float("inf"), False
+
+            with self._lock:
+                if healthy != backend.healthy:
+                    logger.info(f"[OLLAMA] {backend.url} is {'back in the pool' if healthy else 'ejected'} "
+                                f"(health check {latency:.2f}s)")
+                backend.healthy = healthy
+                backend.latency = latency
+                if healthy:
+                    backend.failures = 0
+
+    def start_health_checks(self, interval: float = OLLAMA_HEALTH_INTERVAL):
+        if self._health_thread is not None:
+            return
+
+        def loop():
+            while True:
+                self.check_health()
+                time.sleep(interval)
+
+        self._health_thread = threading.Thread(target=loop, name="ollama-health", daemon=True)
+        self._health_thread.start()
+
+    def warm_up(self, options: dict | None = None):
+        """
+        Loads the model on every backend so the first analysis does not pay the load time.
+        Pass the options real calls use: a different num_ctx makes Ollama reload the runner.
+        """
+        payload = {"model": self.model_name, "keep_alive": self.keep_alive}
+        if options:
+            payload["options"] = options
+        for backend in self.backends:
+            started = time.perf_counter()
+            try:
+                requests.post(
+                    backend.url + "/api/generate",
+                    json=payload,
+                    timeout=OLLAMA_REQUEST_TIMEOUT,
+                ).raise_for_status()
+                logger.info(f"[OLLAMA] {self.model_name} loaded on {backend.url} in {time.perf_counter() - started:.1f}s")
+            except requests.RequestException as e:
+                logger.error(f"[OLLAMA] Warm-up of {backend.url} failed: {e}")
+
+
+ollama_pool = OllamaPool(OLLAMA_URLS)
@@ -0,0 +1,84 @@
+import json
+from collections import deque
+from datetime import date
+from pathlib import Path
+from config import SOURCES_FILE
+from call_dates import call_date_from_name
+from loguru import logger
+
+
+class Source:
+    def __init__(self, folder_id: str, branch: str, weight: int = 1):
+        self.folder_id = folder_id
+        self.branch = branch
+        self.weight = max(int(weight), 1)
+
+    def __repr__(self):
+        return f"Source({self.branch}, {self.folder_id}, weight={self.weight})"
+
+
+def load_sources(path: Path = Path(SOURCES_FILE)) -> list[Source]:
+    """Reads [{"folder_id": ..., "branch": ..., "weight": 1}, ...] from SOURCES_FILE."""
+    with path.open("r", encoding="utf-8") as f:
+        return [Source(s["folder_id"], s.get("branch", ""), s.get("weight", 1)) for s in json.load(f)]
+
+
+def is_today(file_name: str) -> bool:
+    # Нераспознанные имена просто идут в backlog
+    return call_date_from_name(file_name) == date.today()
+
+
+class FairScheduler:
+    """
+    Interleaves files from several sources with smooth weighted round-robin.
+    Today's calls go to a priority lane that is always drained first, with the same
+    round-robin between sources inside it, so one branch's backlog cannot starve the others.
+    """
+
+    def __init__(self, sources: list[Source]):
+        self.sources = {s.folder_id: s for s in sources}
+        self.lanes = {
+            lane: {s.folder_id: deque() for s in sources}
+            for lane in ("today", "backlog")
+        }
+        self._current = {s.folder_id: 0 for s in sources}
+        self._seen: set[str] = set()
+
+    def enqueue(self, source: Source, items: list[dict]) -> int:
+        added = 0
+        for item in items:
+            if item["id"] in self._seen:
+                continue
+            self._seen.add(item["id"])
+            lane = "today" if is_today(item["name"]) else "backlog"
+            self.lanes[lane][source.folder_id].append(item)
+            added += 1
+        if added:
+            logger.info(f"[SCHEDULER] {added} files queued for branch {source.branch or source.folder_id}")
+        return added
+
+    def requeue(self, source: Source, item: dict):
+        """Puts an already seen item (e.g. after a failed download) back at the end of its queue."""
+        lane = "today" if is_today(item["name"]) else "backlog"
+        self.lanes[lane][source.folder_id].append(item)
+
+    def next(self) -> tuple[Source, dict] | None:
+        for lane in self.lanes.values():
+            active = [folder_id for folder_id, queue in lane.items() if queue]
+            if not active:
+                continue
+
+            # Smooth weighted round-robin: у каждого источника копится кредит по весу
+            total = sum(self.sources[folder_id].weight for folder_id in active)
+            for folder_id in active:
+                self._current[folder_id] += self.sources[folder_id].weight
+            chosen = max(active, key=lambda folder_id: self._current[folder_id])
+            self._current[chosen] -= total
+            return self.sources[chosen], lane[chosen].popleft()
+        return None
+
+    def pending(self) -> dict:
+        return {
+            source.branch or folder_id: {lane: len(queues[folder_id]) for lane, queues in self.lanes.items()}
+            for folder_id, source in self.sources.items()
+        }
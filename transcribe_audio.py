@@ -1,62 +1,366 @@
 import time
-import whisperx
-import torch
+import subprocess
+from functools import lru_cache
 import numpy as np
 from pathlib import Path
-from resemblyzer import VoiceEncoder, preprocess_wav
-from sklearn.cluster import AgglomerativeClustering
 from call_analysis import get_speaker_roles
+from transcript import Segment, Transcript
+from config import DIARIZATION_MODE, DIARIZATION_WINDOW_SECONDS, SILENCE_THRESHOLD_DBFS, \
+    SPEAKER_SIMILARITY_THRESHOLD, MAX_SPEAKERS, MIN_SPEAKER_SHARE, TRANSCRIBE_CHUNK_SECONDS, \
+    TRANSCRIBE_CHUNK_OVERLAP_SECONDS, ROLE_SAMPLE_SEGMENTS, TRANSCRIPTS_DIR
 from loguru import logger
 
-def process_audio_file(audio_path: Path, window_size: float = 3.0):
-    try:
-        wav = preprocess_wav(audio_path)
-        sr = 16000
+# whisperx, torch, resemblyzer и sklearn импортируются лениво при первой транскрибации,
+# чтобы API и OAuth эндпоинты стартовали без загрузки ML зависимостей
+SAMPLE_RATE = 16000
+# Окна короче этого resemblyzer эмбеддит нестабильно
+MIN_EMBED_SECONDS = 0.5
 
-        seg_samples = int(window_size * sr)
-        segments = [wav[i:i + seg_samples] for i in range(0, len(wav), seg_samples)]
 
-        encoder = VoiceEncoder()
-        embeddings = np.array([encoder.embed_utterance(seg) for seg in segments])
+def window_dbfs(window: np.ndarray) -> float:
+    rms = np.sqrt(np.mean(np.square(window, dtype=np.float64)))
+    return 20 * np.log10(rms + 1e-10)
 
-        clustering = AgglomerativeClustering(n_clusters=2)
-        labels = clustering.fit_predict(embeddings)
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        compute_type = "float16" if device == "cuda" else "float32"
-        model = whisperx.load_model("small", device=device, compute_type=compute_type)
-        result = model.transcribe(str(audio_path))
+@lru_cache(maxsize=1)
+def load_voice_encoder():
+    from resemblyzer import VoiceEncoder
+    return VoiceEncoder()
 
-        final_results = []
-        for seg in result["segments"]:
-            start_time = seg["start"]
-            idx = min(int(start_time // window_size), len(labels) - 1)
-            speaker_name = f"Speaker {labels[idx] + 1}"
-            final_results.append({
-                "start": start_time,
-                "end": seg["end"],
-                "speaker": speaker_name,
-                "text": seg["text"].strip()
-            })
-        dialog_text_for_roles = "\n".join(
-            [f"[{r['start']:.2f}s - {r['end']:.2f}s] {r['speaker']}: {r['text']}" for r in final_results])
 
-        roles = get_speaker_roles(dialog_text_for_roles)
+def embed_window(encoder, window: np.ndarray) -> np.ndarray:
+    from resemblyzer.audio import normalize_volume
+    return encoder.embed_utterance(normalize_volume(window, -30, increase_only=True))
+
+
+def iter_voiced_windows(wav: np.ndarray, window_size: float, silence_dbfs: float = SILENCE_THRESHOLD_DBFS):
+    """Yields (window_index, window) for windows louder than silence_dbfs; silent windows are never embedded."""
+    seg_samples = int(window_size * SAMPLE_RATE)
+    min_samples = int(MIN_EMBED_SECONDS * SAMPLE_RATE)
+    for idx, start in enumerate(range(0, len(wav), seg_samples)):
+        window = wav[start:start + seg_samples]
+        if len(window) < min_samples or window_dbfs(window) < silence_dbfs:
+            continue
+        yield idx, window
+
+
+class OnlineSpeakerClustering:
+    """
+    Centroid-based online clustering of speaker embeddings.
+    Only running centroid sums are kept, so memory does not grow with the call length.
+    """
+
+    def __init__(self, threshold: float = SPEAKER_SIMILARITY_THRESHOLD, max_speakers: int = MAX_SPEAKERS,
+                 min_share: float = MIN_SPEAKER_SHARE):
+        self.threshold = threshold
+        self.max_speakers = max_speakers
+        self.min_share = min_share
+        self.sums: list[np.ndarray] = []
+        self.counts: list[int] = []
+
+    def _centroids(self) -> np.ndarray:
+        centroids = np.array(self.sums)
+        return centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+
+    def assign(self, embedding: np.ndarray) -> int:
+        if self.sums:
+            similarities = self._centroids() @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold or len(self.sums) >= self.max_speakers:
+                self.sums[best] += embedding
+                self.counts[best] += 1
+                return best
+
+        self.sums.append(embedding.astype(np.float64).copy())
+        self.counts.append(1)
+        return len(self.sums) - 1
+
+    def speaker_map(self) -> dict[int, int]:
+        """
+        Estimates the speaker count: clusters holding less than min_share of voiced windows
+        are merged into the closest major cluster. Returns {cluster: speaker number}.
+        """
+        if not self.counts:
+            return {}
+
+        total = sum(self.counts)
+        major = [i for i, c in enumerate(self.counts) if c / total >= self.min_share]
+        if not major:
+            major = [int(np.argmax(self.counts))]
+
+        centroids = self._centroids()
+        mapping = {}
+        for cluster in range(len(self.counts)):
+            if cluster in major:
+                mapping[cluster] = cluster
+            else:
+                mapping[cluster] = max(major, key=lambda m: float(centroids[m] @ centroids[cluster]))
+
+        numbering = {cluster: n for n, cluster in enumerate(sorted(major), start=1)}
+        return {cluster: numbering[target] for cluster, target in mapping.items()}
+
+    def closest(self, cluster: int, candidates) -> int:
+        centroids = self._centroids()
+        return max(candidates, key=lambda c: float(centroids[c] @ centroids[cluster]))
+
+
+def diarize_online(wav: np.ndarray, window_size: float, encoder=None) -> np.ndarray:
+    """Returns a per-window speaker number array (0 for silent windows)."""
+    encoder = encoder or load_voice_encoder()
+    clustering = OnlineSpeakerClustering()
+    n_windows = -(-len(wav) // int(window_size * SAMPLE_RATE))
+    clusters = np.full(n_windows, -1, dtype=np.int16)
+
+    for idx, window in iter_voiced_windows(wav, window_size):
+        embedding = embed_window(encoder, window)
+        clusters[idx] = clustering.assign(embedding)
+
+    mapping = clustering.speaker_map()
+    labels = np.zeros(n_windows, dtype=np.int16)
+    for cluster, speaker in mapping.items():
+        labels[clusters == cluster] = speaker
+
+    logger.info(f"Diarization: {len(mapping)} clusters -> {len(set(mapping.values()))} speakers, "
+                f"{int((clusters >= 0).sum())}/{n_windows} voiced windows")
+    return labels
+
+
+def diarize_agglomerative(audio_path: Path, window_size: float) -> np.ndarray:
+    from resemblyzer import preprocess_wav
+    from sklearn.cluster import AgglomerativeClustering
+
+    wav = preprocess_wav(audio_path)
+
+    seg_samples = int(window_size * SAMPLE_RATE)
+    segments = [wav[i:i + seg_samples] for i in range(0, len(wav), seg_samples)]
+
+    encoder = load_voice_encoder()
+    embeddings = np.array([encoder.embed_utterance(seg) for seg in segments])
+
+    clustering = AgglomerativeClustering(n_clusters=2)
+    return clustering.fit_predict(embeddings) + 1
+
+
+def speaker_by_overlap(start: float, end: float, labels: np.ndarray, window_size: float) -> int:
+    """Picks the speaker with the largest time overlap with [start, end]; silent windows do not vote."""
+    votes: dict[int, float] = {}
+    first = int(start // window_size)
+    last = min(int(np.ceil(end / window_size)), len(labels))
+    for idx in range(first, last):
+        speaker = int(labels[idx])
+        if speaker <= 0:
+            continue
+        overlap = min(end, (idx + 1) * window_size) - max(start, idx * window_size)
+        if overlap > 0:
+            votes[speaker] = votes.get(speaker, 0.0) + overlap
+
+    if votes:
+        return max(votes, key=votes.get)
+
+    # Сегмент целиком попал в тишину — берём ближайшее озвученное окно
+    voiced = np.flatnonzero(labels > 0)
+    if len(voiced) == 0:
+        return 1
+    nearest = voiced[np.argmin(np.abs(voiced - min(first, len(labels) - 1)))]
+    return int(labels[nearest])
+
+
+@lru_cache(maxsize=1)
+def load_whisper_model(name: str = "small"):
+    import torch
+    import whisperx
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    compute_type = "float16" if device == "cuda" else "float32"
+    return whisperx.load_model(name, device=device, compute_type=compute_type)
 
-        for r in final_results:
-            r["speaker"] = roles.get(r["speaker"], r["speaker"])
 
-        processed_files = []
-        output_folder = Path("transcribed_files")
+def stream_pcm_chunks(audio_path: Path, chunk_seconds: float, overlap_seconds: float):
+    """
+    Decodes audio with ffmpeg into 16 kHz mono PCM and yields (offset, chunk, is_last).
+    Each chunk starts with the last overlap_seconds of the previous one; at most two chunks are held in memory.
+    """
+    cmd = ["ffmpeg", "-nostdin", "-i", str(audio_path), "-f", "s16le", "-ac", "1",
+           "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    chunk_bytes = int(chunk_seconds * SAMPLE_RATE) * 2
+    overlap_samples = int(overlap_seconds * SAMPLE_RATE)
+
+    def read_fresh():
+        raw = proc.stdout.read(chunk_bytes)
+        return np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0 if raw else None
+
+    try:
+        tail = np.zeros(0, dtype=np.float32)
+        offset = 0.0
+        fresh = read_fresh()
+        while fresh is not None:
+            next_fresh = read_fresh()
+            chunk = np.concatenate([tail, fresh])
+            yield offset, chunk, next_fresh is None
+
+            tail = chunk[-overlap_samples:] if overlap_samples else chunk[:0]
+            offset += (len(chunk) - len(tail)) / SAMPLE_RATE
+            fresh = next_fresh
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def process_audio_file_chunked(audio_path: Path, chunk_seconds: float = TRANSCRIBE_CHUNK_SECONDS,
+                               overlap_seconds: float = TRANSCRIBE_CHUNK_OVERLAP_SECONDS,
+                               output_folder: Path = TRANSCRIPTS_DIR):
+    """
+    Transcribes and diarizes the recording chunk by chunk, writing segments to the transcript file as they
+    are produced. Peak memory depends on chunk_seconds, not on the recording length; only the text
+    segments are kept for the returned Transcript.
+    """
+    try:
+        window_size = DIARIZATION_WINDOW_SECONDS
+        # Границы чанков совпадают с сеткой окон диаризации
+        chunk_seconds = max(1, round(chunk_seconds / window_size)) * window_size
+        overlap_seconds = min(overlap_seconds, chunk_seconds / 2)
+
+        model = load_whisper_model()
+        encoder = load_voice_encoder()
+        clustering = OnlineSpeakerClustering()
+        window_clusters: dict[int, int] = {}
+        emitted_until = 0.0
+        roles = None
+        cluster_roles: dict[int, str] = {}
+        pending = []
+        transcript = Transcript(audio_path.stem)
 
         output_folder.mkdir(parents=True, exist_ok=True)
         output_path = output_folder / f"{audio_path.stem}_with_roles.txt"
+
+        def speaker_label(mapping, cluster):
+            return f"Speaker {mapping.get(cluster, cluster + 1)}"
+
+        def write_segment(f, start, end, cluster, text):
+            # Нумерация speaker_map меняется по ходу записи, поэтому роль берём по id кластера
+            if cluster not in cluster_roles:
+                # Кластер появился после выборки — берём роль ближайшего из уже известных
+                known = [c for c in cluster_roles if c >= 0]
+                cluster_roles[cluster] = (
+                    cluster_roles[clustering.closest(cluster, known)] if known else speaker_label({}, cluster)
+                )
+            segment = Segment(start, end, cluster_roles[cluster], text)
+            transcript.append(segment)
+            f.write(segment.to_line() + "\n")
+
+        def flush_pending(f):
+            # Роли определяются по первым ROLE_SAMPLE_SEGMENTS сегментам и фиксируются за кластерами
+            nonlocal roles
+            mapping = clustering.speaker_map()
+            dialog_text_for_roles = "\n".join(
+                f"[{start:.2f}s - {end:.2f}s] {speaker_label(mapping, cluster)}: {text}"
+                for start, end, cluster, text in pending)
+            roles = get_speaker_roles(dialog_text_for_roles) if pending else {}
+            for cluster in [-1, *range(len(clustering.counts))]:
+                label = speaker_label(mapping, cluster)
+                cluster_roles[cluster] = roles.get(label, label)
+            for segment in pending:
+                write_segment(f, *segment)
+            pending.clear()
+
         with open(output_path, "w", encoding="utf-8") as f:
-            for r in final_results:
-                f.write(f"[{r['start']:.2f}s - {r['end']:.2f}s] {r['speaker']}: {r['text']}\n")
+            for offset, chunk, is_last in stream_pcm_chunks(audio_path, chunk_seconds, overlap_seconds):
+                chunk_started = time.time()
+                fresh_start = offset + (overlap_seconds if offset > 0 else 0.0)
+                fresh = chunk[int(round((fresh_start - offset) * SAMPLE_RATE)):]
+                first_window = int(round(fresh_start / window_size))
+                for idx, window in iter_voiced_windows(fresh, window_size):
+                    embedding = embed_window(encoder, window)
+                    window_clusters[first_window + idx] = clustering.assign(embedding)
+
+                base = int(offset // window_size)
+                chunk_end = offset + len(chunk) / SAMPLE_RATE
+                n_windows = int(np.ceil(chunk_end / window_size)) - base
+                clusters = np.array([window_clusters.get(base + i, -1) for i in range(n_windows)], dtype=np.int16)
+
+                # Сегменты, начавшиеся в зоне перекрытия, допишет следующий чанк
+                commit_until = chunk_end if is_last else chunk_end - overlap_seconds
+                for seg in model.transcribe(chunk)["segments"]:
+                    start, end = seg["start"] + offset, seg["end"] + offset
+                    if start < emitted_until or start >= commit_until:
+                        continue
+                    cluster = speaker_by_overlap(start - base * window_size, end - base * window_size,
+                                                 clusters + 1, window_size) - 1
+                    text = seg["text"].strip()
+                    emitted_until = max(emitted_until, end)
+
+                    if roles is None:
+                        pending.append((start, end, cluster, text))
+                        if len(pending) >= ROLE_SAMPLE_SEGMENTS:
+                            flush_pending(f)
+                    else:
+                        write_segment(f, start, end, cluster, text)
+                f.flush()
+
+                emitted_until = max(emitted_until, commit_until)
+                window_clusters = {i: c for i, c in window_clusters.items() if i >= base}
+                logger.info(f"Chunk at {offset:.0f}s of {audio_path.name} processed in {time.time() - chunk_started:.1f}s")
+
+            if roles is None:
+                flush_pending(f)
+
+        transcript.artifacts.append(output_path)
+        return transcript
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        raise e
+
+
+def process_audio_file(audio_path: Path, window_size: float | None = None, mode: str | None = None,
+                       output_folder: Path = TRANSCRIPTS_DIR):
+    """Chunked transcription when TRANSCRIBE_CHUNK_SECONDS > 0, otherwise the whole recording at once."""
+    if TRANSCRIBE_CHUNK_SECONDS > 0:
+        if window_size is not None or mode is not None:
+            # Чанковый режим всегда использует online диаризацию с DIARIZATION_WINDOW_SECONDS
+            logger.warning(f"window_size={window_size} and mode={mode} are ignored for {audio_path.name}: "
+                           f"chunked transcription is on (TRANSCRIBE_CHUNK_SECONDS={TRANSCRIBE_CHUNK_SECONDS})")
+        return process_audio_file_chunked(audio_path, output_folder=output_folder)
+
+    return process_audio_file_full(audio_path, 3.0 if window_size is None else window_size,
+                                   mode or DIARIZATION_MODE, output_folder)
+
+
+def process_audio_file_full(audio_path: Path, window_size: float = 3.0, mode: str = DIARIZATION_MODE,
+                            output_folder: Path = TRANSCRIPTS_DIR):
+    """Decodes, diarizes and transcribes the whole recording in memory."""
+    try:
+        if mode == "online":
+            import whisperx
+
+            window_size = DIARIZATION_WINDOW_SECONDS
+            audio = whisperx.load_audio(str(audio_path))
+            labels = diarize_online(audio, window_size)
+        else:
+            audio = str(audio_path)
+            labels = diarize_agglomerative(audio_path, window_size)
+
+        model = load_whisper_model()
+        result = model.transcribe(audio)
+
+        transcript = Transcript(audio_path.stem)
+        for seg in result["segments"]:
+            start_time = seg["start"]
+            if mode == "online":
+                speaker = speaker_by_overlap(start_time, seg["end"], labels, window_size)
+            else:
+                speaker = labels[min(int(start_time // window_size), len(labels) - 1)]
+            transcript.append(Segment(start_time, seg["end"], f"Speaker {speaker}", seg["text"].strip()))
+
+        roles = get_speaker_roles(transcript.to_text())
+
+        for segment in transcript.segments:
+            segment.speaker = roles.get(segment.speaker, segment.speaker)
 
-        processed_files.append(str(output_path))
-        return processed_files
+        transcript.write_text(output_folder)
+        return transcript
     except Exception as e:
         logger.error(f"Error: {e}")
         raise e
@@ -0,0 +1,70 @@
+import re
+from pathlib import Path
+
+LINE_PATTERN = re.compile(r"^\[(?P<start>[\d.]+)s - (?P<end>[\d.]+)s\] (?P<speaker>[^:]+): ?(?P<text>.*)$")
+
+
+class Segment:
+    __slots__ = ("start", "end", "speaker", "text")
+
+    def __init__(self, start: float, end: float, speaker: str, text: str):
+        self.start = start
+        self.end = end
+        self.speaker = speaker
+        self.text = text
+
+    def to_line(self) -> str:
+        return f"[{self.start:.2f}s - {self.end:.2f}s] {self.speaker}: {self.text}"
+
+    @classmethod
+    def from_line(cls, line: str):
+        match = LINE_PATTERN.match(line.strip())
+        if not match:
+            return None
+        return cls(float(match["start"]), float(match["end"]), match["speaker"], match["text"])
+
+
+class Transcript:
+    """
+    Diarized transcript passed in memory from transcription to analysis.
+    artifacts holds files written for upload; analysis never reads them back.
+    """
+    __slots__ = ("name", "segments", "artifacts")
+
+    def __init__(self, name: str, segments: list[Segment] | None = None):
+        self.name = name
+        self.segments = segments if segments is not None else []
+        self.artifacts: list[Path] = []
+
+    def append(self, segment: Segment):
+        self.segments.append(segment)
+
+    def has_speaker(self, speaker: str) -> bool:
+        return any(seg.speaker == speaker for seg in self.segments)
+
+    def to_text(self) -> str:
+        return "\n".join(seg.to_line() for seg in self.segments)
+
+    def write_text(self, output_folder: Path) -> Path:
+        output_folder.mkdir(parents=True, exist_ok=True)
+        output_path = output_folder / f"{self.name}_with_roles.txt"
+        with open(output_path, "w", encoding="utf-8") as f:
+            for seg in self.segments:
+                f.write(seg.to_line() + "\n")
+        self.artifacts.append(output_path)
+        return output_path
+
+    @classmethod
+    def from_text(cls, name: str, text: str) -> "Transcript":
+        transcript = cls(name)
+        for line in text.splitlines():
+            segment = Segment.from_line(line)
+            if segment:
+                transcript.append(segment)
+        return transcript
+
+    @classmethod
+    def from_text_file(cls, file_path) -> "Transcript":
+        file_path = Path(file_path)
+        with open(file_path, "r", encoding="utf-8") as f:
+            return cls.from_text(file_path.stem.removesuffix("_with_roles"), f.read())
@@ -0,0 +1,75 @@
+import asyncio
+from pathlib import Path
+from config import AUDIO_EXTENSIONS, WORKSPACE_DIR, WORKSPACE_BUDGET_BYTES, WORKSPACE_DEFAULT_FILE_BYTES
+from loguru import logger
+
+
+class Workspace:
+    """
+    Local directory for downloaded audio with a byte budget.
+    Downloads reserve space before they start and wait while the budget is exhausted;
+    space is returned as soon as the audio file is released.
+    """
+
+    def __init__(self, root: Path, budget_bytes: int):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self._reserved: dict[Path, int] = {}
+        self._condition = asyncio.Condition()
+
+    @property
+    def usage_bytes(self) -> int:
+        return sum(self._reserved.values())
+
+    def stats(self) -> dict:
+        return {
+            "usage_bytes": self.usage_bytes,
+            "budget_bytes": self.budget_bytes,
+            "files": len(self._reserved),
+        }
+
+    @staticmethod
+    def _is_download(path: Path) -> bool:
+        # Только то, что сюда пишет скачивание: аудио и .html страницы ошибок Drive
+        suffix = path.suffix.lower()
+        return bool(suffix) and (suffix == ".html" or suffix in (AUDIO_EXTENSIONS or ""))
+
+    def cleanup_orphans(self):
+        """
+        Removes downloads left by a crashed run; must be called before any download starts.
+        Other files are kept in case WORKSPACE_DIR points at a shared directory.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        removed, freed = 0, 0
+        for path in self.root.rglob("*"):
+            if path.is_file() and path not in self._reserved and self._is_download(path):
+                freed += path.stat().st_size
+                path.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            logger.info(f"[WORKSPACE] Removed {removed} orphaned files ({freed / 2 ** 20:.1f} MB) from {self.root}")
+
+    async def reserve(self, path: Path, size: int | None):
+        size = size or WORKSPACE_DEFAULT_FILE_BYTES
+        async with self._condition:
+            # Файл больше бюджета допускается только в пустой workspace
+            await self._condition.wait_for(
+                lambda: not self._reserved or self.usage_bytes + size <= self.budget_bytes
+            )
+            self._reserved[path] = size
+
+    async def commit(self, path: Path):
+        """Replaces the estimated reservation with the actual size of the downloaded file."""
+        async with self._condition:
+            if path in self._reserved and path.exists():
+                self._reserved[path] = path.stat().st_size
+                self._condition.notify_all()
+
+    async def release(self, path: Path):
+        path.unlink(missing_ok=True)
+        async with self._condition:
+            self._reserved.pop(path, None)
+            self._condition.notify_all()
+
+
+workspace = Workspace(Path(WORKSPACE_DIR), WORKSPACE_BUDGET_BYTES)